@@ -0,0 +1,149 @@
+"""
+ASGI entry point serving the API from a thread pool. Requires an ASGI server, for example:
+
+    pip install uvicorn
+    uvicorn asgi:app --workers 4
+
+The handlers and peewee are synchronous, so each request runs in one of ASGI_THREADS threads while the event loop
+keeps accepting connections.
+"""
+import asyncio
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import settings
+from main import create_app
+
+
+class WsgiToAsgi:
+    """
+    ASGI app running a WSGI app in a pool of threads, so as many requests as threads run at the same time.
+    """
+
+    def __init__(self, wsgi_app, threads):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.executor.shutdown(wait=False)
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        if scope['type'] != 'http':
+            raise ValueError(f"Unsupported scope type: {scope['type']}")
+
+        body = io.BytesIO()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.write(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        body.seek(0)
+
+        # Streamed responses stop at their next chunk once the client is gone.
+        disconnected = threading.Event()
+
+        async def wait_for_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        loop = asyncio.get_running_loop()
+        watcher = loop.create_task(wait_for_disconnect())
+        try:
+            await loop.run_in_executor(self.executor, self._run, loop, self._get_environ(scope, body), send,
+                                       disconnected)
+        finally:
+            watcher.cancel()
+
+    @staticmethod
+    def _get_environ(scope, body):
+        """
+        Return the WSGI environ of an ASGI http scope and its body.
+        """
+        script_name = scope.get('root_path', '').encode().decode('latin1')
+        path_info = scope['path'].encode().decode('latin1')
+        if path_info.startswith(script_name):
+            path_info = path_info[len(script_name):]
+
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': script_name,
+            'PATH_INFO': path_info,
+            'QUERY_STRING': scope['query_string'].decode('ascii'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1').upper().replace('-', '_')
+            if name not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+                name = f'HTTP_{name}'
+            value = value.decode('latin1')
+            environ[name] = f'{environ[name]},{value}' if name in environ else value
+
+        return environ
+
+    def _run(self, loop, environ, send, disconnected):
+        """
+        Run the WSGI app in a thread of the pool and send its response from the event loop.
+        """
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response_start.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+
+            response_start.update(status=int(status.split(' ', 1)[0]),
+                                  headers=[(name.lower().encode('latin1'), value.encode('latin1'))
+                                           for name, value in headers])
+            return write
+
+        def write(chunk):
+            if not response_start.get('sent'):
+                response_start['sent'] = True
+                send_message({'type': 'http.response.start', 'status': response_start['status'],
+                              'headers': response_start['headers']})
+            if chunk:
+                send_message({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        chunks = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in chunks:
+                if disconnected.is_set():
+                    return
+                write(chunk)
+
+            write(b'')
+            send_message({'type': 'http.response.body'})
+        finally:
+            # Closing the response runs its close callbacks, such as releasing the slot of an expensive request.
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+
+app = WsgiToAsgi(create_app(), settings.ASGI_THREADS)
@@ -0,0 +1,456 @@
+"""
+Load test and benchmark the Pet API.
+
+Seeds persons and pets through the models, serves the app on a local port and drives every route concurrently.
+Reports requests per second, p50/p95/p99 latency, queries per request and the peak RSS of each route, and writes the
+results as JSON so runs before and after a change can be compared:
+
+    python benchmark.py run --persons 10000 --output before.json
+    python benchmark.py run --persons 10000 --output after.json
+    python benchmark.py compare before.json after.json
+
+Worker startup, the time to import the app and create it, is measured in fresh interpreters:
+
+    python benchmark.py startup --output startup.json
+
+The benchmark uses the _TEST tables of the database configured by the DATABASE_* environment variables, and a
+temporary SQLite database when DATABASE_ENGINE is not set. The tables are recreated on every run. Rate limits and the
+cap on expensive requests are off unless RATE_LIMIT_BACKEND or MAX_EXPENSIVE_REQUESTS is set.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ['TEST'] = 'True'
+if 'DATABASE_ENGINE' not in os.environ:
+    os.environ['DATABASE_ENGINE'] = 'sqlite'
+    os.environ['DATABASE_NAME'] = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+# All requests come from one address, which the rate limit and the cap on expensive requests in flight would reject.
+# Both are off unless set, so the results measure the routes and not the limits.
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'none')
+os.environ.setdefault('MAX_EXPENSIVE_REQUESTS', '1000000')
+
+
+def percentile(values, percent):
+    """
+    Return the percentile of sorted values using the nearest rank.
+    """
+    if not values:
+        return None
+
+    index = max(0, min(len(values) - 1, int(round(percent / 100 * len(values))) - 1))
+    return values[index]
+
+
+def seed(persons, pets, married):
+    """
+    Recreate the tables with persons, a share of them married in pairs, and pets spread over owners and null owner.
+    Return the ids of the persons and pets created.
+    """
+    from peewee import Case
+    from models import db, Person, Pet, insert_many, rebuild_counters
+    from utils import _create_tables, _drop_tables
+
+    _drop_tables()
+    _create_tables()
+
+    rng = random.Random(0)
+    with db:
+        person_ids = insert_many(Person, [dict(first_name=f'First{i}', last_name=f'Last{i % 1000}')
+                                          for i in range(persons)])
+
+        pairs = int(persons * married) // 2
+        if pairs:
+            first_id = person_ids[0]
+            last_id = person_ids[pairs * 2 - 1]
+            offset = Person.id - first_id
+            (Person
+             .update(partner=Case(None, [(offset == offset / 2 * 2, Person.id + 1)], Person.id - 1))
+             .where(Person.id.between(first_id, last_id))
+             .execute())
+
+        pet_ids = insert_many(Pet, [dict(name=f'Pet{i}', owner=rng.choice(person_ids) if rng.random() < 0.9 else None)
+                                    for i in range(pets)])
+
+    with db.connection_context():
+        rebuild_counters()
+
+    return person_ids, pet_ids
+
+
+class Routes:
+    """
+    Generates requests for every route of the API from the seeded ids.
+    """
+    # Persons removed by each request of the routes that remove persons, which are run last
+    REMOVED_PER_REQUEST = {'remove_person': 1, 'remove_persons_job': 10}
+    IDS_PER_REQUEST = 10
+
+    def __init__(self, person_ids, pet_ids):
+        from models import Job, Pet
+
+        self.rng = random.Random(1)
+        self.lock = threading.Lock()
+        self.person_ids = person_ids
+        self.pet_ids = pet_ids
+        self.owned_pets = [(owner_id, pet_id) for pet_id, owner_id in
+                           Pet.select(Pet.id, Pet.owner).where(Pet.owner.is_null(False)).tuples()]
+        self.removable_ids = list(reversed(person_ids))
+        # A finished job for the job status route to read
+        self.job_id = Job.create(kind='remove_persons', status='done', items='[]', total=0).id
+
+    def _person_id(self):
+        with self.lock:
+            return self.rng.choice(self.person_ids)
+
+    def _ids(self, ids):
+        with self.lock:
+            return ','.join(str(item_id) for item_id in self.rng.sample(ids, self.IDS_PER_REQUEST))
+
+    def _owned_pet(self):
+        with self.lock:
+            return self.rng.choice(self.owned_pets)
+
+    def _removable_ids(self, count):
+        with self.lock:
+            return [self.removable_ids.pop() for _ in range(count)]
+
+    def _batch(self):
+        return [dict(op='create_person', ref='person', body=dict(first_name='A', last_name='Bench')),
+                dict(op='create_pet', person_id='$person', body=dict(name='Bench')),
+                dict(op='update_person', person_id=self._person_id(), body=dict(last_name='Bench'))]
+
+    def requests(self, name, requests):
+        """
+        Return how many of requests the route can send, since each removed person can be removed only once.
+        """
+        if name not in self.REMOVED_PER_REQUEST:
+            return requests
+
+        return min(requests, len(self.removable_ids) // self.REMOVED_PER_REQUEST[name])
+
+    def all(self):
+        return {
+            'person_list': lambda: ('GET', '/persons', None),
+            'person': lambda: ('GET', f'/persons/{self._person_id()}', None),
+            'persons_by_ids': lambda: ('GET', f'/persons?ids={self._ids(self.person_ids)}', None),
+            'household': lambda: ('GET', f'/persons/{self._person_id()}/household', None),
+            'create_person': lambda: ('POST', '/persons', dict(first_name='A', last_name='Bench')),
+            'create_persons_bulk': lambda: ('POST', '/persons:bulk',
+                                            [dict(first_name=f'A{i}', last_name='Bench') for i in range(100)]),
+            'update_person': lambda: ('PATCH', f'/persons/{self._person_id()}', dict(last_name='Bench')),
+            'pet': lambda: ('GET', '/persons/{}/pets/{}'.format(*self._owned_pet()), None),
+            'pets_by_ids': lambda: ('GET', f'/pets?ids={self._ids(self.pet_ids)}', None),
+            'pet_list_null_owner': lambda: ('GET', '/persons/pets', None),
+            'pet_list': lambda: ('GET', f'/persons/{self._person_id()}/pets', None),
+            'create_pet': lambda: ('POST', f'/persons/{self._person_id()}/pets', dict(name='Bench')),
+            'create_pets_bulk': lambda: ('POST', f'/persons/{self._person_id()}/pets:bulk',
+                                         [dict(name=f'Bench{i}') for i in range(100)]),
+            'person_count': lambda: ('GET', '/persons?count_only=true', None),
+            'batch': lambda: ('POST', '/batch', self._batch()),
+            'change_list': lambda: ('GET', '/changes', None),
+            'job': lambda: ('GET', f'/jobs/{self.job_id}', None),
+            'stats': lambda: ('GET', '/stats', None),
+            'cache_stats': lambda: ('GET', '/cache/stats', None),
+            'metrics': lambda: ('GET', '/metrics', None),
+            'remove_person': lambda: ('DELETE', f'/persons/{self._removable_ids(1)[0]}', None),
+            'remove_persons_job': lambda: ('POST', '/persons:remove',
+                                           self._removable_ids(self.REMOVED_PER_REQUEST['remove_persons_job'])),
+        }
+
+
+class QueryCounter:
+    """
+    Counts the SQL statements executed by the database.
+    """
+
+    def __init__(self, database):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._execute_sql = database.execute_sql
+        database.execute_sql = self._counting_execute_sql
+
+    def _counting_execute_sql(self, *args, **kwargs):
+        with self._lock:
+            self.count += 1
+        return self._execute_sql(*args, **kwargs)
+
+
+def get_rss_kb():
+    """
+    Return the resident set size of the process in KB, or None where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except OSError:
+        return None
+
+
+class RssSampler:
+    """
+    Samples the resident set size of the process in a thread, so the peak while a route runs can be read.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = None
+        self._lock = threading.Lock()
+        threading.Thread(target=self._sample, daemon=True).start()
+
+    def _sample(self):
+        while True:
+            rss = get_rss_kb()
+            if rss is None:
+                return
+
+            with self._lock:
+                self.peak = rss if self.peak is None else max(self.peak, rss)
+            time.sleep(self.interval)
+
+    def reset(self):
+        """
+        Return the peak since the last reset, and start a new one from the current size.
+        """
+        with self._lock:
+            peak = self.peak
+            self.peak = get_rss_kb()
+        return peak
+
+
+def send(base_url, method, path, body):
+    """
+    Send a request and return its latency in seconds and its status code, or None if it could not be sent.
+    """
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(base_url + path, data=data, method=method,
+                                     headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        status = e.code
+    except urllib.error.URLError:
+        status = None
+
+    return time.perf_counter() - start, status
+
+
+def is_success(status):
+    return status is not None and 200 <= status < 400
+
+
+def to_ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def run_route(base_url, make_request, requests, concurrency, queries, rss):
+    """
+    Send requests to one route from concurrent workers and return its statistics.
+    """
+    queries_before = queries.count
+    rss.reset()
+
+    def worker(_):
+        method, path, body = make_request()
+        return send(base_url, method, path, body)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(worker, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    # Failed requests, such as a 404 or a 429, are left out of the latencies so they cannot pass for fast successes.
+    latencies = sorted(latency for latency, status in results if is_success(status))
+    statuses = Counter(str(status) for _, status in results)
+    return {
+        'requests': requests,
+        'errors': sum(1 for _, status in results if not is_success(status)),
+        'statuses': dict(sorted(statuses.items())),
+        'requests_per_second': round(requests / elapsed, 1),
+        'p50_ms': to_ms(percentile(latencies, 50)),
+        'p95_ms': to_ms(percentile(latencies, 95)),
+        'p99_ms': to_ms(percentile(latencies, 99)),
+        'queries_per_request': round((queries.count - queries_before) / requests, 2),
+        'peak_rss_kb': rss.reset()
+    }
+
+
+def run(args):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    import settings
+    from main import create_app
+    from models import db
+
+    seed_start = time.perf_counter()
+    person_ids, pet_ids = seed(args.persons, args.pets, args.married)
+    seed_seconds = time.perf_counter() - seed_start
+
+    route_requests = Routes(person_ids, pet_ids)
+    routes = route_requests.all()
+    selected = args.routes.split(',') if args.routes else list(routes)
+    unknown = set(selected) - set(routes)
+    if unknown:
+        raise SystemExit(f'Unknown routes: {", ".join(sorted(unknown))}')
+
+    queries = QueryCounter(db)
+    rss = RssSampler()
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, create_app(), threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.port}'
+
+    results = {}
+    failed = []
+    try:
+        for name in selected:
+            requests = route_requests.requests(name, args.requests)
+            if requests == 0:
+                print(f'{name:<22} skipped, no persons left to remove', file=sys.stderr)
+                continue
+
+            results[name] = run_route(base_url, routes[name], requests, args.concurrency, queries, rss)
+            print(format_result(name, results[name]), file=sys.stderr)
+            if results[name]['errors'] * 2 > requests:
+                failed.append(name)
+    finally:
+        server.shutdown()
+
+    report = {
+        'config': {
+            'engine': settings.DATABASE['engine'],
+            'persons': args.persons,
+            'pets': args.pets,
+            'married': args.married,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'rate_limit_backend': settings.RATE_LIMIT['backend'],
+            'max_expensive_requests': settings.MAX_EXPENSIVE_REQUESTS
+        },
+        'seed_seconds': round(seed_seconds, 2),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'routes': results
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    print(f'process peak RSS {report["peak_rss_kb"]} KB including seeding, results written to {args.output}',
+          file=sys.stderr)
+    if failed:
+        raise SystemExit('Most requests failed, so their results are not valid: ' +
+                         ', '.join(f'{name} {results[name]["statuses"]}' for name in failed))
+
+
+def format_result(name, result):
+    return (f'{name:<22} {result["requests_per_second"]:>9} req/s  p50 {str(result["p50_ms"]):>8} ms  '
+            f'p95 {str(result["p95_ms"]):>8} ms  p99 {str(result["p99_ms"]):>8} ms  '
+            f'{result["queries_per_request"]:>6} queries/req  peak RSS {str(result["peak_rss_kb"]):>8} KB  '
+            f'{result["errors"]} errors'
+            f'{"" if not result["errors"] else " " + str(result["statuses"])}')
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print(f'{"route":<22} {"req/s before":>12} {"after":>9} {"change":>8}  {"p99 ms before":>13} {"after":>9} '
+          f'{"change":>8}')
+    for name, result in after['routes'].items():
+        previous = before['routes'].get(name)
+        if previous is None or previous['p99_ms'] is None or result['p99_ms'] is None:
+            continue
+
+        rps_change = (result['requests_per_second'] / previous['requests_per_second'] - 1) * 100
+        p99_change = (result['p99_ms'] / previous['p99_ms'] - 1) * 100
+        print(f'{name:<22} {previous["requests_per_second"]:>12} {result["requests_per_second"]:>9} '
+              f'{rps_change:>+7.1f}%  {previous["p99_ms"]:>13} {result["p99_ms"]:>9} {p99_change:>+7.1f}%')
+
+    print(f'process peak RSS {before["peak_rss_kb"]} KB -> {after["peak_rss_kb"]} KB')
+
+
+def measure_startup(code, repeat, environ):
+    """
+    Return the median and min seconds to run code in a fresh interpreter.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, env=environ, cwd=os.path.dirname(__file__) or '.')
+        times.append(time.perf_counter() - start)
+
+    return {'median_ms': round(statistics.median(times) * 1000, 1), 'min_ms': round(min(times) * 1000, 1)}
+
+
+def startup(args):
+    results = {
+        'interpreter': measure_startup('pass', args.repeat, os.environ),
+        'swagger_enabled': measure_startup('import main; main.create_app()', args.repeat,
+                                           dict(os.environ, SWAGGER_ENABLED='true')),
+        'swagger_disabled': measure_startup('import main; main.create_app()', args.repeat,
+                                            dict(os.environ, SWAGGER_ENABLED='false'))
+    }
+    for name, result in results.items():
+        print(f'{name:<22} median {result["median_ms"]:>8} ms  min {result["min_ms"]:>8} ms', file=sys.stderr)
+
+    with open(args.output, 'w') as f:
+        json.dump({'repeat': args.repeat, 'startup': results}, f, indent=2, sort_keys=True)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Load test and benchmark the Pet API.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help='seed the database and benchmark every route')
+    run_parser.add_argument('--persons', type=int, default=10000, help='persons to seed (default 10000)')
+    run_parser.add_argument('--pets', type=int, default=None, help='pets to seed (default twice the persons)')
+    run_parser.add_argument('--married', type=float, default=0.5, help='share of married persons (default 0.5)')
+    run_parser.add_argument('--requests', type=int, default=500, help='requests per route (default 500)')
+    run_parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients (default 16)')
+    run_parser.add_argument('--routes', help='comma separated routes to run (default all)')
+    run_parser.add_argument('--output', default='benchmark.json', help='results file (default benchmark.json)')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser('compare', help='compare two results files')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.set_defaults(func=compare)
+
+    startup_parser = commands.add_parser('startup', help='measure the time to import and create the app')
+    startup_parser.add_argument('--repeat', type=int, default=10, help='interpreters to start (default 10)')
+    startup_parser.add_argument('--output', default='startup.json', help='results file (default startup.json)')
+    startup_parser.set_defaults(func=startup)
+
+    args = parser.parse_args(argv)
+    if getattr(args, 'pets', 0) is None:
+        args.pets = args.persons * 2
+
+    return args
+
+
+if __name__ == '__main__':
+    arguments = parse_args(sys.argv[1:])
+    arguments.func(arguments)
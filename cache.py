@@ -0,0 +1,303 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import settings
+from models import db, using, Person, Pet
+from serializers import person_row_to_dict, select_person_rows, select_pet_rows
+
+
+# Cache Backends
+class MemoryCache:
+    """
+    In-process LRU cache where entries expire after ttl seconds.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'backend': 'memory', 'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+class RedisCache:
+    """
+    Cache shared between processes, stored in Redis with a ttl in seconds.
+    """
+
+    def __init__(self, url, ttl, prefix='pets:'):
+        import redis
+
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value):
+        self._client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self._client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        keys = list(self._client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self._client.delete(*keys)
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'backend': 'redis', 'hits': self.hits, 'misses': self.misses, 'size': None}
+
+
+class NullCache:
+    """
+    Cache that stores nothing, every lookup goes to the database.
+    """
+
+    def __init__(self):
+        self.misses = 0
+
+    def get(self, key):
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        self.misses = 0
+
+    def stats(self):
+        return {'backend': 'none', 'hits': 0, 'misses': self.misses, 'size': 0}
+
+
+def create_cache(config):
+    """
+    Return the cache backend in config, either memory, redis or none.
+    """
+    if config['backend'] == 'memory':
+        return MemoryCache(config['max_size'], config['ttl'])
+
+    if config['backend'] == 'redis':
+        return RedisCache(config['url'], config['ttl'])
+
+    if config['backend'] == 'none':
+        return NullCache()
+
+    raise ValueError(f"Unsupported cache backend: {config['backend']}")
+
+
+cache = create_cache(settings.CACHE)
+
+
+# Read-through lookups. Misses are loaded from the primary, since a lagging replica could put back an entry that a
+# write just invalidated.
+def _person_key(person_id):
+    return f'person:{person_id}'
+
+
+def _pet_key(pet_id):
+    return f'pet:{pet_id}'
+
+
+def get_person(person_id):
+    """
+    Return the serialized person, loading it from the database on a cache miss, or None if not found.
+    The returned dict is shared with the cache and must not be modified.
+    """
+    result = cache.get(_person_key(person_id))
+    if result is None:
+        with using(db):
+            row = select_person_rows().where(Person.id == person_id).first()
+
+        if row is None:
+            return None
+
+        result = person_row_to_dict(row)
+        cache.set(_person_key(person_id), result)
+
+    return result
+
+
+def get_pet(person_id, pet_id):
+    """
+    Return the serialized pet of an owner, loading it from the database on a cache miss, or None if not found.
+    The pet is cached without its owner, which is composed from the cached person.
+    """
+    result = cache.get(_pet_key(pet_id))
+    if result is None:
+        with using(db):
+            row = select_pet_rows().where(Pet.id == pet_id).first()
+
+        if row is None:
+            return None
+
+        result = {'id': row[0], 'name': row[1], 'owner': row[2]}
+        cache.set(_pet_key(pet_id), result)
+        if row[2] is not None:
+            cache.set(_person_key(row[2]), person_row_to_dict(row[2:]))
+
+    if result['owner'] != person_id:
+        return None
+
+    owner = get_person(person_id)
+    if owner is None:
+        return None
+
+    return dict(result, owner=owner)
+
+
+def get_persons(person_ids):
+    """
+    Return the serialized persons found by id, loading all cache misses with one query.
+    The returned dicts are shared with the cache and must not be modified.
+    """
+    results = {}
+    misses = []
+    for person_id in set(person_ids):
+        result = cache.get(_person_key(person_id))
+        if result is None:
+            misses.append(person_id)
+        else:
+            results[person_id] = result
+
+    if misses:
+        with using(db):
+            rows = list(select_person_rows().where(Person.id.in_(misses)))
+
+        for row in rows:
+            results[row[0]] = person_row_to_dict(row)
+            cache.set(_person_key(row[0]), results[row[0]])
+
+    return results
+
+
+def get_pets(pet_ids):
+    """
+    Return the serialized pets found by id with their owner, loading all cache misses with one query.
+    Owners are composed from the cached persons, which are loaded with one more query if missing.
+    """
+    pets = {}
+    misses = []
+    for pet_id in set(pet_ids):
+        result = cache.get(_pet_key(pet_id))
+        if result is None:
+            misses.append(pet_id)
+        else:
+            pets[pet_id] = result
+
+    owners = {}
+    if misses:
+        with using(db):
+            rows = list(select_pet_rows().where(Pet.id.in_(misses)))
+
+        for row in rows:
+            pets[row[0]] = {'id': row[0], 'name': row[1], 'owner': row[2]}
+            cache.set(_pet_key(row[0]), pets[row[0]])
+            if row[2] is not None:
+                owners[row[2]] = person_row_to_dict(row[2:])
+                cache.set(_person_key(row[2]), owners[row[2]])
+
+    owner_ids = {pet['owner'] for pet in pets.values() if pet['owner'] is not None}
+    owners.update(get_persons(owner_ids - owners.keys()))
+
+    results = {}
+    for pet_id, pet in pets.items():
+        if pet['owner'] is None:
+            results[pet_id] = pet
+        elif pet['owner'] in owners:
+            results[pet_id] = dict(pet, owner=owners[pet['owner']])
+
+    return results
+
+
+_deferred = threading.local()
+
+
+@contextmanager
+def deferred_invalidation():
+    """
+    Delay the invalidations in the block to its end, so they happen after a transaction around the block commits.
+    Otherwise a request could cache the rows again before their changes are committed.
+    """
+    keys = _deferred.keys = []
+    try:
+        yield
+    finally:
+        _deferred.keys = None
+        cache.delete(*keys)
+
+
+def _invalidate(keys):
+    deferred = getattr(_deferred, 'keys', None)
+    if deferred is not None:
+        deferred.extend(keys)
+    else:
+        cache.delete(*keys)
+
+
+def invalidate_persons(*person_ids):
+    """
+    Remove persons from the cache.
+    """
+    _invalidate([_person_key(person_id) for person_id in person_ids if person_id is not None])
+
+
+def invalidate_pets(*pet_ids):
+    """
+    Remove pets from the cache.
+    """
+    _invalidate([_pet_key(pet_id) for pet_id in pet_ids if pet_id is not None])
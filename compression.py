@@ -0,0 +1,85 @@
+import gzip
+import zlib
+
+import settings
+from metrics import timing
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson')
+
+
+def get_encodings():
+    """
+    Return the content codings the server can compress with, in order of preference.
+    """
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def _compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=settings.COMPRESSION['brotli_quality'])
+
+    return gzip.compress(data, settings.COMPRESSION['gzip_level'])
+
+
+def _compress_stream(chunks, encoding):
+    """
+    Yield the chunks of a streamed body compressed as they are produced. The compressor is flushed after every
+    EXPORT_PAGE_SIZE chunks, a page of NDJSON rows, so the client gets each page before the next one is fetched.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=settings.COMPRESSION['brotli_quality'])
+        compress, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(settings.COMPRESSION['gzip_level'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress, finish = compressor.compress, compressor.flush
+
+        def flush():
+            return compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    for index, chunk in enumerate(chunks, 1):
+        data = compress(chunk)
+        if index % settings.EXPORT_PAGE_SIZE == 0:
+            data += flush()
+        if data:
+            yield data
+
+    yield finish()
+
+
+def compress_response(request, response):
+    """
+    Compress a JSON response with the best coding the client accepts in Accept-Encoding, unless it is small.
+    A strong ETag becomes weak since the compressed bytes differ from the representation it was computed for.
+    """
+    if (response.mimetype not in COMPRESSIBLE_MIMETYPES or response.status_code in (204, 304) or
+            'Content-Encoding' in response.headers):
+        return response
+
+    if not response.is_streamed and len(response.get_data()) < settings.COMPRESSION['min_size']:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(get_encodings())
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        # Streams are compressed while they are sent, after the timings of the request are recorded, so the compress
+        # phase only covers bodies compressed here.
+        response.response = _compress_stream(response.iter_encoded(), encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        with timing('compress'):
+            response.set_data(_compress(response.get_data(), encoding))
+
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+    return response
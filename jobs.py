@@ -0,0 +1,123 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import operations
+import settings
+from models import db, Job
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(settings.JOBS['workers'], thread_name_prefix='jobs')
+
+        return _executor
+
+
+def job_to_dict(job):
+    """
+    Return the status of a job.
+    """
+    return {'id': job.id, 'kind': job.kind, 'status': job.status, 'total': job.total, 'processed': job.processed,
+            'rows_removed': job.rows_removed, 'attempts': job.attempts, 'error': job.error}
+
+
+def submit_job(job_id):
+    """
+    Process a job in the worker pool, or right away if there are no workers.
+    """
+    if settings.JOBS['workers'] == 0:
+        run_job(job_id)
+    else:
+        _get_executor().submit(run_job, job_id)
+
+
+def enqueue_remove_persons(person_ids):
+    """
+    Create and submit a job removing persons like remove_person. Return the job.
+    """
+    job = Job.create(kind='remove_persons', items=json.dumps(person_ids), total=len(person_ids))
+    submit_job(job.id)
+    return job
+
+
+def _claim(job_id):
+    """
+    Start an attempt at a pending job, or at a running job whose worker stopped renewing its lease.
+    Return whether this worker holds the job.
+    """
+    now = time.time()
+    claimed = (Job
+               .update(status='running', attempts=Job.attempts + 1, lease_expires=now + settings.JOBS['lease_seconds'])
+               .where(Job.id == job_id,
+                      (Job.status == 'pending') | ((Job.status == 'running') & (Job.lease_expires < now)))
+               .execute())
+    return claimed == 1
+
+
+def _process(job):
+    """
+    Process the items of a job after the processed ones, one batch per transaction. Each transaction also records the
+    progress of the job, so a retry resumes after the last committed batch.
+    """
+    items = json.loads(job.items)
+    batch_size = settings.JOBS['batch_size']
+    for start in range(job.processed, len(items), batch_size):
+        batch = items[start:start + batch_size]
+
+        def progress(rows_removed):
+            (Job
+             .update(processed=start + len(batch), rows_removed=Job.rows_removed + rows_removed,
+                     lease_expires=time.time() + settings.JOBS['lease_seconds'])
+             .where(Job.id == job.id)
+             .execute())
+
+        operations.remove_persons(batch, progress)
+
+    Job.update(status='done', lease_expires=None).where(Job.id == job.id).execute()
+
+
+def run_job(job_id):
+    """
+    Process a job unless another worker holds it, retrying a failed attempt until the job has had max_attempts.
+    Removing a person that no longer exists does nothing, so a retry that repeats items is safe.
+    """
+    # Jobs run without workers share the connection of the request.
+    opened = db.connect(reuse_if_open=True)
+    try:
+        while _claim(job_id):
+            job = Job.get_by_id(job_id)
+            try:
+                _process(job)
+                return
+            except Exception as e:
+                logger.error('Job %s attempt %s failed: %s', job_id, job.attempts, e)
+                status = 'failed' if job.attempts >= settings.JOBS['max_attempts'] else 'pending'
+                Job.update(status=status, error=str(e), lease_expires=None).where(Job.id == job_id).execute()
+    finally:
+        if opened:
+            db.close()
+
+
+def resume_jobs():
+    """
+    Process the pending jobs and the running jobs whose worker stopped, such as after a restart.
+    """
+    with db.connection_context():
+        job_ids = [job_id for job_id, in Job.select(Job.id).where(Job.status.in_(['pending', 'running'])).tuples()]
+
+    for job_id in job_ids:
+        run_job(job_id)
+
+
+if __name__ == '__main__':
+    resume_jobs()
@@ -0,0 +1,175 @@
+import threading
+import time
+from collections import OrderedDict
+
+import settings
+
+
+# Rate limiter Backends
+class MemoryRateLimiter:
+    """
+    In-process token buckets per client, refilled with rate tokens per second up to burst tokens. Only the buckets of
+    the max_clients most recent clients are kept.
+    """
+
+    def __init__(self, rate, burst, max_clients):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """
+        Take a token from the bucket of key. Return 0 if there was one, or the seconds until there will be one.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisRateLimiter:
+    """
+    Token buckets per client shared between processes, stored in Redis and updated atomically by a script.
+    """
+
+    # Buckets are refilled with the time of the Redis server so the clocks of the processes do not matter.
+    SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local clock = redis.call('TIME')
+        local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    """
+
+    def __init__(self, url, rate, burst, prefix='pets:rate:'):
+        import redis
+
+        self.rate = rate
+        self.burst = burst
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def acquire(self, key):
+        return float(self._script(keys=[self.prefix + key], args=[self.rate, self.burst]))
+
+    def clear(self):
+        keys = list(self._client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self._client.delete(*keys)
+
+
+class NullRateLimiter:
+    """
+    Rate limiter that lets every request through.
+    """
+
+    def acquire(self, key):
+        return 0
+
+    def clear(self):
+        pass
+
+
+def create_rate_limiter(config):
+    """
+    Return the rate limiter backend in config, either memory, redis or none.
+    """
+    if config['backend'] == 'memory':
+        return MemoryRateLimiter(config['rate'], config['burst'], config['max_clients'])
+
+    if config['backend'] == 'redis':
+        return RedisRateLimiter(config['url'], config['rate'], config['burst'])
+
+    if config['backend'] == 'none':
+        return NullRateLimiter()
+
+    raise ValueError(f"Unsupported rate limit backend: {config['backend']}")
+
+
+class ConcurrencyLimiter:
+    """
+    Limit on the requests in flight in a process, which fails instead of queueing once it is reached.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Return whether a slot was taken. Each slot taken must be released.
+        """
+        with self._lock:
+            if self.in_flight >= self.limit:
+                return False
+
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def release_after(self, response):
+        """
+        Release a slot once a response is sent: right away unless it is streamed, else when the stream ends or is
+        closed, whichever comes first.
+        """
+        if not response.is_streamed:
+            self.release()
+            return
+
+        released = []
+        lock = threading.Lock()
+
+        def release():
+            with lock:
+                if released:
+                    return
+                released.append(True)
+
+            self.release()
+
+        def stream(chunks):
+            try:
+                yield from chunks
+            finally:
+                release()
+
+        response.response = stream(response.response)
+        response.call_on_close(release)
+
+
+rate_limiter = create_rate_limiter(settings.RATE_LIMIT)
+expensive_requests = ConcurrencyLimiter(settings.MAX_EXPENSIVE_REQUESTS)
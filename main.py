@@ -1,237 +1,597 @@
-from flasgger import Swagger, swag_from
-from flask import Flask, request
-from playhouse.shortcuts import model_to_dict
+import math
+import os
+import threading
+import time
+
+from flask import Blueprint, Flask, Response, current_app, g, request
+
+import operations
+import settings
+from cache import cache, get_person, get_persons, get_pet, get_pets
+from compression import compress_response
+from jobs import enqueue_remove_persons, job_to_dict
+from limits import expensive_requests, rate_limiter
+from metrics import finish_request, instrument_database, render, start_request, timing
+from models import (db, replicas, Job, Person, Pet, choose_replica, use_database, get_version, get_stats,
+                    InvalidRequestException, NotFoundException, ServiceUnavailableException, TooManyRequestsException)
+from serializers import (PERSON_COLUMNS, PERSON_ENCODERS, PET_COLUMNS, PET_ENCODERS, encode_change_row,
+                         household_rows_to_dict, select_change_rows, select_household_rows, select_person_rows,
+                         select_pet_rows)
+from utils import (generate_response, generate_message_response, generate_error_response, generate_item_result,
+                   generate_item_error_result, generate_stream_response, generate_conditional_response,
+                   generate_event_stream_response,
+                   generate_multi_get_response, generate_not_modified_response, generate_page_response, count_persons,
+                   filter_persons, filter_pets, get_bool_arg, get_bulk_items, get_format_arg, get_ids_arg, get_int_arg,
+                   get_limit_arg, get_list_etag, get_page_args, iterate_pages, model_to_dict, paginate, poll_changes,
+                   wants_event_stream, wants_ndjson)
+
+api = Blueprint('api', __name__)
+
+# Endpoints reading or writing many rows, of which at most MAX_EXPENSIVE_REQUESTS are in flight per process.
+EXPENSIVE_ENDPOINTS = {'api.person_list', 'api.pets', 'api.pet_list_null_owner', 'api.pet_list', 'api.change_list',
+                       'api.create_persons_bulk', 'api.create_pets_bulk', 'api.remove_persons_job', 'api.batch'}
+# Endpoints that are never rate limited, so monitoring keeps working under load.
+UNLIMITED_ENDPOINTS = {'api.metrics'}
+# Paths of the Swagger UI, its static files and the spec, served by flasgger.
+SWAGGER_PATHS = ('/apidocs', '/apispec_1.json', '/flasgger_static/', '/oauth2-redirect.html')
+# Set on responses to writes with the time of the write, so the client's next reads within the sticky window go to
+# the primary.
+LAST_WRITE_COOKIE = 'last_write'
+
+
+def create_app(config=None):
+    """
+    Return a new Flask app serving the API, with config overriding the default configuration.
+    """
+    app = Flask(__name__)
+    app.config['SWAGGER_ENABLED'] = settings.SWAGGER_ENABLED
+    app.config['SWAGGER'] = {
+        'title': 'Pet API',
+        'description': 'Simple API for marrying partners and adopting pets.',
+        "termsOfService": None,
+        "version": "1.0.1",
+        # Each view is documented by the yml file named after it, read when the spec is first requested.
+        'doc_dir': os.path.join(app.root_path, '.docs', 'main')
+    }
+    app.config.update(config or {})
+
+    app.before_request(_start_metrics)
+    app.after_request(_finish_metrics)
+    app.after_request(_compress)
+    app.before_request(_limit_requests)
+    app.after_request(_hold_limits)
+    app.teardown_request(_release_limits)
+    app.before_request(_db_connect)
+    app.after_request(_remember_write)
+    app.teardown_request(_db_close)
+    app.register_blueprint(api)
+    if app.config['SWAGGER_ENABLED']:
+        app.wsgi_app = _LazySwagger(app)
+
+    for database in [db, *replicas]:
+        instrument_database(database)
+
+    return app
+
+
+class _LazySwagger:
+    """
+    WSGI middleware serving the Swagger UI and spec of an app from a second app, which is created with flasgger on the
+    first request to them. flasgger and its dependencies take most of the import time, so workers start without them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.docs_app = None
+        self._lock = threading.Lock()
+
+    def _create_docs_app(self):
+        from flasgger import Swagger
+
+        api_app = self.app
+
+        class ApiSwagger(Swagger):
+            def get_apispecs(self, endpoint='apispec_1'):
+                # The spec documents the views of the API app.
+                with api_app.app_context():
+                    return super().get_apispecs(endpoint)
+
+        docs_app = Flask(__name__)
+        docs_app.config['SWAGGER'] = self.app.config['SWAGGER']
+        ApiSwagger(docs_app)
+        return docs_app
+
+    def __call__(self, environ, start_response):
+        if not environ.get('PATH_INFO', '').startswith(SWAGGER_PATHS):
+            return self.wsgi_app(environ, start_response)
+
+        with self._lock:
+            if self.docs_app is None:
+                self.docs_app = self._create_docs_app()
+
+        return self.docs_app(environ, start_response)
+
+
+def _start_metrics():
+    start_request()
+    if request.method in ('POST', 'PATCH'):
+        with timing('parse'):
+            request.get_json(force=True, silent=True)
+
+
+def _finish_metrics(response):
+    return finish_request(request, response)
+
+
+def _compress(response):
+    return compress_response(request, response)
+
+
+def _get_client():
+    header = settings.RATE_LIMIT['client_header']
+    return (header and request.headers.get(header)) or request.remote_addr or 'unknown'
+
+
+def _limit_requests():
+    """
+    Reject requests over the rate limit of their client, and expensive requests over the limit in flight, before
+    they take a connection.
+    """
+    if request.endpoint is None or request.endpoint in UNLIMITED_ENDPOINTS:
+        return None
+
+    try:
+        wait = rate_limiter.acquire(_get_client())
+        if wait > 0:
+            raise TooManyRequestsException('Too many requests', wait)
+
+        if request.endpoint in EXPENSIVE_ENDPOINTS:
+            if not expensive_requests.acquire():
+                raise ServiceUnavailableException('Too many requests in progress', 1)
+            g.expensive_request = True
+    except Exception as e:
+        current_app.logger.warning(e)
+        return generate_error_response(e)
+
+    return None
+
+
+def _hold_limits(response):
+    # Streamed responses hold their slot while they stream.
+    if g.pop('expensive_request', False):
+        expensive_requests.release_after(response)
+
+    return response
+
+
+def _release_limits(exception):
+    # Requests that failed before they had a response release their slot at teardown.
+    if g.pop('expensive_request', False):
+        expensive_requests.release()
+
+
+def _wrote_recently():
+    """
+    Return whether the client wrote within the sticky window, according to the cookie set by its last write.
+    """
+    try:
+        last_write = float(request.cookies.get(LAST_WRITE_COOKIE, 0))
+    except ValueError:
+        return False
+
+    return time.time() - last_write < settings.REPLICA_STICKY_SECONDS
+
+
+def _db_connect():
+    database = db
+    if request.method in ('GET', 'HEAD') and replicas and not _wrote_recently():
+        database = choose_replica()
+        use_database(database)
+
+    database.connect(reuse_if_open=True)
 
-from models import Person, Pet, InvalidRequestException, NotFoundException, ConflictException
-from utils import generate_response, generate_message_response, generate_error_response
 
-app = Flask(__name__)
-app.config['SWAGGER'] = {
-    'title': 'Pet API',
-    'description': 'Simple API for marrying partners and adopting pets.',
-    "termsOfService": None,
-    "version": "1.0.1"
-}
-swagger = Swagger(app)
+def _db_close(exception):
+    use_database(None)
+    for database in [db, *replicas]:
+        if not database.is_closed():
+            database.close()
 
 
-@app.route('/persons', methods=['GET'])
-@swag_from('.docs/main/person_list.yml')
+def _remember_write(response):
+    if replicas and request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+        response.set_cookie(LAST_WRITE_COOKIE, str(time.time()), max_age=math.ceil(settings.REPLICA_STICKY_SECONDS),
+                            httponly=True)
+
+    return response
+
+
+@api.route('/persons', methods=['GET'])
 def person_list():
     """
-    Get a list of persons.
+    Get a page of persons, or the persons with the ids requested.
     """
-    results = Person.select().order_by(Person.id.desc()).execute()
-    response = generate_response({'data': [model_to_dict(result) for result in results]}, 200)
+    try:
+        ids = get_ids_arg(request.args)
+        if ids is not None:
+            return generate_multi_get_response(ids, get_persons(ids), 'Person not found')
+
+        if get_bool_arg(request.args, 'count_only'):
+            return generate_response({'count': count_persons(request.args)}, 200)
+
+        limit, after_id = get_page_args(request.args)
+        row_format = get_format_arg(request)
+        encode = PERSON_ENCODERS[row_format]
+        query = filter_persons(select_person_rows(), request.args)
+
+        etag = get_list_etag(request, get_version())
+        if request.if_none_match.contains_weak(etag):
+            return generate_not_modified_response(etag)
+
+        if wants_ndjson(request):
+            return generate_stream_response(iterate_pages(query, Person, after_id), encode, 200, etag)
+
+        results, next_cursor = paginate(query, Person, limit, after_id)
+        response = generate_page_response((encode(result) for result in results), next_cursor, 200, etag,
+                                          PERSON_COLUMNS if row_format == 'columnar' else None)
+    except Exception as e:
+        current_app.logger.error(e)
+        response = generate_error_response(e)
+
     return response
 
 
-@app.route('/persons/<int:person_id>', methods=['GET'])
-@swag_from('.docs/main/person.yml')
+@api.route('/persons/<int:person_id>', methods=['GET'])
 def person(person_id):
     """
     Get an existing person.
     """
     try:
-        result = Person.get_or_none(Person.id == person_id)
+        result = get_person(person_id)
         if result is None:
             raise NotFoundException('Person not found')
 
-        response = generate_response(model_to_dict(result), 200)
+        response = generate_conditional_response(request, result, 200)
+    except Exception as e:
+        current_app.logger.error(e)
+        response = generate_error_response(e)
+
+    return response
+
+
+@api.route('/persons/<int:person_id>/household', methods=['GET'])
+def household(person_id):
+    """
+    Get an existing person with their partner and the pets of both.
+    """
+    try:
+        rows = list(select_household_rows(person_id))
+        if not rows:
+            raise NotFoundException('Person not found')
+
+        response = generate_conditional_response(request, household_rows_to_dict(rows), 200)
     except Exception as e:
-        app.logger.error(e)
+        current_app.logger.error(e)
         response = generate_error_response(e)
 
     return response
 
 
-@app.route('/persons', methods=['POST'])
-@swag_from('.docs/main/create_person.yml')
+@api.route('/persons', methods=['POST'])
 def create_person():
     """
     Create a person and marries partners if eligible.
     """
     try:
         data = request.get_json(force=True)
-        first_name = data.get('first_name')
-        last_name = data.get('last_name')
-        partner_id = data.get('partner_id')
-        partner = None
-
-        if first_name is None:
-            raise InvalidRequestException('First name is required')
-
-        if last_name is None:
-            raise InvalidRequestException('Last name is required')
+        result = operations.create_person(data.get('first_name'), data.get('last_name'), data.get('partner_id'))
+        response = generate_response(model_to_dict(result), 201)
+    except Exception as e:
+        current_app.logger.error(e)
+        response = generate_error_response(e)
 
-        if partner_id is not None:
-            partner = Person.get_or_none(Person.id == partner_id)
-            if partner is None:
-                raise NotFoundException('Partner not found')
-            if partner.partner is not None:
-                raise ConflictException('Partner already married')
+    return response
 
-        result = Person(first_name=first_name, last_name=last_name, partner=partner)
-        result.save()
 
-        if partner is not None:
-            partner.partner = result
-            partner.save()
+@api.route('/persons:bulk', methods=['POST'])
+def create_persons_bulk():
+    """
+    Create persons in bulk and marries partners if eligible.
+    """
+    try:
+        items = get_bulk_items(request.get_json(force=True))
+        results = [generate_item_error_result(result) if isinstance(result, Exception)
+                   else generate_item_result(model_to_dict(result), 201) for result in operations.create_persons(items)]
 
-        response = generate_response(model_to_dict(result), 201)
+        response = generate_response({'data': results}, 200)
     except Exception as e:
-        app.logger.error(e)
+        current_app.logger.error(e)
         response = generate_error_response(e)
 
     return response
 
 
-@app.route('/persons/<int:person_id>', methods=['PATCH'])
-@swag_from('.docs/main/update_person.yml')
+@api.route('/persons/<int:person_id>', methods=['PATCH'])
 def update_person(person_id):
     """
     Update a person and marries partners if eligible.
     """
     try:
-        result = Person.get_or_none(Person.id == person_id)
-        if result is None:
-            raise NotFoundException('Person not found')
-
         data = request.get_json(force=True)
+        result = operations.update_person(person_id, data.get('first_name'), data.get('last_name'),
+                                          data.get('partner_id'))
+        response = generate_response(model_to_dict(result), 200)
+    except Exception as e:
+        current_app.logger.error(e)
+        response = generate_error_response(e)
 
-        first_name = data.get('first_name')
-        if first_name is not None:
-            result.first_name = first_name
-
-        last_name = data.get('last_name')
-        if last_name is not None:
-            result.last_name = last_name
+    return response
 
-        partner_id = data.get('partner_id')
-        if partner_id is not None:
-            partner = result.partner
-            if partner is None:
-                partner = Person.get_or_none(Person.id == partner_id)
-                if partner is None:
-                    raise NotFoundException('Partner not found')
-                if partner.partner is not None:
-                    raise ConflictException('Partner already married')
 
-            if partner_id != partner.id:
-                raise InvalidRequestException('Partner does not match partner_id')
+@api.route('/persons/<int:person_id>', methods=['DELETE'])
+def remove_person(person_id):
+    """
+    Remove a person and transfers pets to partner or null partner if not married.
+    """
+    return generate_message_response(f'Number of rows removed: {operations.remove_person(person_id)}', 200)
 
-            if partner is not None:
-                partner.partner = result
-                partner.save()
 
-            result.partner = partner
+@api.route('/persons:remove', methods=['POST'])
+def remove_persons_job():
+    """
+    Remove persons in a background job and transfers their pets to their partner or null partner if not married.
+    """
+    try:
+        person_ids = request.get_json(force=True)
+        if not isinstance(person_ids, list) or not all(operations.is_id(person_id) for person_id in person_ids):
+            raise InvalidRequestException('Body must be a list of person ids')
 
-        result.save()
+        if len(person_ids) > settings.MAX_BULK_REMOVE_SIZE:
+            raise InvalidRequestException(f'Body must have at most {settings.MAX_BULK_REMOVE_SIZE} items')
 
-        response = generate_response(model_to_dict(result), 200)
+        job = enqueue_remove_persons(person_ids)
+        response = generate_response(job_to_dict(Job.get_by_id(job.id)), 202)
+        response.headers['Location'] = f'/jobs/{job.id}'
     except Exception as e:
-        app.logger.error(e)
+        current_app.logger.error(e)
         response = generate_error_response(e)
 
     return response
 
 
-@app.route('/persons/<int:person_id>', methods=['DELETE'])
-@swag_from('.docs/main/remove_person.yml')
-def remove_person(person_id):
+@api.route('/jobs/<int:job_id>', methods=['GET'])
+def job(job_id):
     """
-    Remove a person and transfers pets to partner or null partner if not married.
+    Get the status of a job.
     """
-    result = Person.get_or_none(Person.id == person_id)
-    if result is None:
-        return generate_message_response('Number of rows removed: 0', 200)
-
-    partner = result.partner
-    Pet.update(owner=partner).where(Pet.owner == result).execute()
+    try:
+        result = Job.get_or_none(Job.id == job_id)
+        if result is None:
+            raise NotFoundException('Job not found')
 
-    if partner is not None:
-        partner.partner = None
-        partner.save()
+        response = generate_response(job_to_dict(result), 200)
+    except Exception as e:
+        current_app.logger.error(e)
+        response = generate_error_response(e)
 
-    return generate_message_response(f'Number of rows removed: {result.delete_instance()}', 200)
+    return response
 
 
-@app.route('/persons/<int:person_id>/pets/<int:pet_id>', methods=['GET'])
-@swag_from('.docs/main/pet.yml')
+@api.route('/persons/<int:person_id>/pets/<int:pet_id>', methods=['GET'])
 def pet(person_id, pet_id):
     """
     Get an existing pet from an existing owner.
     """
     try:
-        result = Pet.get_or_none(Pet.owner == person_id, Pet.id == pet_id)
+        result = get_pet(person_id, pet_id)
         if result is None:
             raise NotFoundException('Person and/or pet not found')
 
-        response = generate_response(model_to_dict(result), 200)
+        response = generate_conditional_response(request, result, 200)
+    except Exception as e:
+        current_app.logger.error(e)
+        response = generate_error_response(e)
+
+    return response
+
+
+@api.route('/pets', methods=['GET'])
+def pets():
+    """
+    Get the pets with the ids requested.
+    """
+    try:
+        ids = get_ids_arg(request.args)
+        if ids is None:
+            raise InvalidRequestException('ids is required')
+
+        response = generate_multi_get_response(ids, get_pets(ids), 'Pet not found')
     except Exception as e:
-        app.logger.error(e)
+        current_app.logger.error(e)
         response = generate_error_response(e)
 
     return response
 
 
-@app.route('/persons/pets', methods=['GET'])
-@swag_from('.docs/main/pet_list_null_owner.yml')
+@api.route('/persons/pets', methods=['GET'])
 def pet_list_null_owner():
     """
-    Get a list of pets from null owner.
+    Get a page of pets from null owner.
     """
-    results = Pet.select().where(Pet.owner.is_null()).order_by(Pet.id.desc()).execute()
-    response = generate_response({'data': [model_to_dict(result) for result in results]}, 200)
+    try:
+        limit, after_id = get_page_args(request.args)
+        row_format = get_format_arg(request)
+        encode = PET_ENCODERS[row_format]
+        query = filter_pets(select_pet_rows().where(Pet.owner.is_null()), request.args)
+        if get_bool_arg(request.args, 'count_only'):
+            count = query.count() if request.args.get('name') is not None else get_stats()['unowned_pets']
+            return generate_response({'count': count}, 200)
+
+        etag = get_list_etag(request, get_version())
+        if request.if_none_match.contains_weak(etag):
+            return generate_not_modified_response(etag)
+
+        if wants_ndjson(request):
+            return generate_stream_response(iterate_pages(query, Pet, after_id), encode, 200, etag)
+
+        results, next_cursor = paginate(query, Pet, limit, after_id)
+        response = generate_page_response((encode(result) for result in results), next_cursor, 200, etag,
+                                          PET_COLUMNS if row_format == 'columnar' else None)
+    except Exception as e:
+        current_app.logger.error(e)
+        response = generate_error_response(e)
+
     return response
 
 
-@app.route('/persons/<int:person_id>/pets', methods=['GET'])
-@swag_from('.docs/main/pet_list.yml')
+@api.route('/persons/<int:person_id>/pets', methods=['GET'])
 def pet_list(person_id):
     """
-    Get a list of pets from an existing owner.
+    Get a page of pets from an existing owner.
     """
     try:
+        limit, after_id = get_page_args(request.args)
+        row_format = get_format_arg(request)
+        encode = PET_ENCODERS[row_format]
+
         owner = Person.get_or_none(Person.id == person_id)
         if owner is None:
             raise NotFoundException('Owner not found')
 
-        results = Pet.select().where(Pet.owner == person_id).order_by(Pet.id.desc()).execute()
-        response = generate_response({'data': [model_to_dict(result) for result in results]}, 200)
+        query = filter_pets(select_pet_rows().where(Pet.owner == person_id), request.args)
+        if get_bool_arg(request.args, 'count_only'):
+            return generate_response({'count': query.count()}, 200)
+
+        etag = get_list_etag(request, get_version())
+        if request.if_none_match.contains_weak(etag):
+            return generate_not_modified_response(etag)
+
+        if wants_ndjson(request):
+            return generate_stream_response(iterate_pages(query, Pet, after_id), encode, 200, etag)
+
+        results, next_cursor = paginate(query, Pet, limit, after_id)
+        response = generate_page_response((encode(result) for result in results), next_cursor, 200, etag,
+                                          PET_COLUMNS if row_format == 'columnar' else None)
     except Exception as e:
-        app.logger.error(e)
+        current_app.logger.error(e)
         response = generate_error_response(e)
 
     return response
 
 
-@app.route('/persons/<int:person_id>/pets', methods=['POST'])
-@swag_from('.docs/main/create_pet.yml')
+@api.route('/persons/<int:person_id>/pets', methods=['POST'])
 def create_pet(person_id):
     """
     Create a pet for an existing owner.
     """
     try:
-        owner = Person.get_or_none(Person.id == person_id)
-        if owner is None:
-            raise NotFoundException('Owner not found')
-
         data = request.get_json(force=True)
-        name = data.get('name')
+        result = operations.create_pet(person_id, data.get('name'))
+        response = generate_response(model_to_dict(result), 201)
+    except Exception as e:
+        current_app.logger.error(e)
+        response = generate_error_response(e)
 
-        if name is None:
-            raise InvalidRequestException('Name is required')
+    return response
 
-        result = Pet(name=name, owner=owner)
-        result.save()
 
-        response = generate_response(model_to_dict(result), 201)
+@api.route('/persons/<int:person_id>/pets:bulk', methods=['POST'])
+def create_pets_bulk(person_id):
+    """
+    Create pets in bulk for an existing owner.
+    """
+    try:
+        items = get_bulk_items(request.get_json(force=True))
+        results = [generate_item_error_result(result) if isinstance(result, Exception)
+                   else generate_item_result(model_to_dict(result), 201)
+                   for result in operations.create_pets(person_id, items)]
+
+        response = generate_response({'data': results}, 200)
+    except Exception as e:
+        current_app.logger.error(e)
+        response = generate_error_response(e)
+
+    return response
+
+
+@api.route('/batch', methods=['POST'])
+def batch():
+    """
+    Run create, update and remove operations in order in one transaction, referencing ids created earlier in the batch.
+    """
+    try:
+        items = get_bulk_items(request.get_json(force=True))
+        results = []
+        for op, result in operations.run_batch(items):
+            if op == 'remove_person':
+                results.append(generate_item_result({'Message': f'Number of rows removed: {result}'}, 200))
+            else:
+                results.append(generate_item_result(result, 200 if op == 'update_person' else 201))
+
+        response = generate_response({'data': results}, 200)
+    except Exception as e:
+        current_app.logger.error(e)
+        response = generate_error_response(e)
+
+    return response
+
+
+@api.route('/changes', methods=['GET'])
+def change_list():
+    """
+    Get a page of changes after a sequence number, or stream them as server-sent events.
+    """
+    try:
+        if wants_event_stream(request):
+            since = get_int_arg(request.headers, 'Last-Event-ID')
+            if since is None:
+                since = get_int_arg(request.args, 'since', 0)
+
+            return generate_event_stream_response(poll_changes(select_change_rows, since), encode_change_row)
+
+        limit = get_limit_arg(request.args)
+        since = get_int_arg(request.args, 'since', 0)
+        results = list(select_change_rows(since).limit(limit))
+        next_cursor = results[-1][0] if results else since
+        response = generate_page_response((encode_change_row(result) for result in results), next_cursor, 200)
     except Exception as e:
-        app.logger.error(e)
+        current_app.logger.error(e)
         response = generate_error_response(e)
 
     return response
 
 
-app.run()
+@api.route('/stats', methods=['GET'])
+def stats():
+    """
+    Get the number of persons, married pairs, pets and pets of null owner, and how many persons have each number of
+    pets.
+    """
+    try:
+        response = generate_response(get_stats(), 200)
+    except Exception as e:
+        current_app.logger.error(e)
+        response = generate_error_response(e)
+
+    return response
+
+
+@api.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """
+    Get the hit and miss counters of the cache.
+    """
+    return generate_response(cache.stats(), 200)
+
+
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Get the request, phase and query histograms in the Prometheus text format.
+    """
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+if __name__ == '__main__':
+    create_app().run()
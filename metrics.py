@@ -0,0 +1,177 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, has_request_context
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+PHASES = ('parse', 'db', 'serialize', 'encode', 'compress')
+
+
+class Histogram:
+    """
+    Prometheus histogram with one series per combination of label values.
+    """
+
+    def __init__(self, name, description, label_names, buckets):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0, 0]
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        """
+        Return the histogram in the Prometheus text exposition format.
+        """
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_values, (counts, total, count) in sorted(self._series.items()):
+                labels = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, label_values))
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f'{self.name}_sum{{{labels}}} {total}')
+                lines.append(f'{self.name}_count{{{labels}}} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Time spent handling requests.',
+                             ('endpoint', 'method', 'status'), DURATION_BUCKETS)
+REQUEST_QUERIES = Histogram('http_request_queries', 'SQL statements executed per request.',
+                            ('endpoint', 'method', 'status'), QUERY_BUCKETS)
+REQUEST_PHASE_DURATION = Histogram('http_request_phase_duration_seconds', 'Time spent per request in each phase.',
+                                   ('endpoint', 'phase'), DURATION_BUCKETS)
+QUERY_DURATION = Histogram('db_query_duration_seconds', 'Time spent executing SQL statements.',
+                           ('operation',), DURATION_BUCKETS)
+HISTOGRAMS = [REQUEST_DURATION, REQUEST_QUERIES, REQUEST_PHASE_DURATION, QUERY_DURATION]
+
+
+def _add_timing(phase, seconds):
+    if has_request_context() and 'timings' in g:
+        g.timings[phase] = g.timings.get(phase, 0) + seconds
+
+
+@contextmanager
+def timing(phase):
+    """
+    Add the time spent in the block to a phase of the current request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_timing(phase, time.perf_counter() - start)
+
+
+def timed(phase):
+    """
+    Decorate a function so the time spent in it is added to a phase of the current request.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with timing(phase):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_database(database):
+    """
+    Time every SQL statement executed by database, count it for the current request and log it if slow.
+    Instrumenting a database twice does nothing, so every app created in a process can call it.
+    """
+    if getattr(database, 'instrumented', False):
+        return
+
+    execute_sql = database.execute_sql
+
+    def timed_execute_sql(sql, params=None, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return execute_sql(sql, params, *args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            QUERY_DURATION.observe(seconds, sql.split(None, 1)[0].upper())
+            if has_request_context() and 'timings' in g:
+                g.timings['db'] = g.timings.get('db', 0) + seconds
+                g.queries += 1
+
+            if seconds * 1000 >= settings.METRICS['slow_query_ms']:
+                logger.warning('Slow query (%.1f ms): %s %s', seconds * 1000, sql, params)
+
+    database.execute_sql = timed_execute_sql
+    database.instrumented = True
+
+
+def start_request():
+    """
+    Start recording the timings of the current request.
+    """
+    g.request_start = time.perf_counter()
+    g.timings = {}
+    g.queries = 0
+
+
+def finish_request(request, response):
+    """
+    Record the timings of the current request and add them to the response if the client asked for them.
+    """
+    if 'timings' not in g:
+        return response
+
+    total = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'unknown'
+    status = str(response.status_code)
+    REQUEST_DURATION.observe(total, endpoint, request.method, status)
+    REQUEST_QUERIES.observe(g.queries, endpoint, request.method, status)
+    for phase in PHASES:
+        REQUEST_PHASE_DURATION.observe(g.timings.get(phase, 0), endpoint, phase)
+
+    if request.headers.get(settings.METRICS['timings_header']):
+        metrics = [f'{phase};dur={g.timings.get(phase, 0) * 1000:.3f}' for phase in PHASES]
+        metrics.append(f'total;dur={total * 1000:.3f}')
+        response.headers['Server-Timing'] = ', '.join(metrics)
+        response.headers['X-Query-Count'] = str(g.queries)
+
+    return response
+
+
+def render():
+    """
+    Return all the histograms in the Prometheus text exposition format.
+    """
+    return ''.join(histogram.render() for histogram in HISTOGRAMS)
+
+
+def clear():
+    for histogram in HISTOGRAMS:
+        histogram.clear()
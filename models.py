@@ -1,40 +1,401 @@
-import os
+import json
+import random
+import threading
+from contextlib import contextmanager
 
+from peewee import BigIntegerField
+from peewee import DoubleField
+from peewee import EXCLUDED
+from peewee import Expression
 from peewee import ForeignKeyField
+from peewee import IntegerField
+from peewee import Metadata
 from peewee import Model
+from peewee import OP
 from peewee import PostgresqlDatabase
+from peewee import SQL
+from peewee import Select
+from peewee import SqliteDatabase
 from peewee import TextField
+from peewee import chunked
+from peewee import fn
+from playhouse.pool import PooledPostgresqlDatabase
+from playhouse.pool import PooledSqliteDatabase
+from playhouse.shortcuts import model_to_dict
 
 import settings
 
-db = PostgresqlDatabase(
-    settings.DATABASE['db_name'],
-    user=settings.DATABASE['user'],
-    password=settings.DATABASE['password'],
-    host=settings.DATABASE['host'],
-    port=settings.DATABASE['port'],
-    autorollback=settings.DATABASE['autorollback']
-)
+
+def create_database(config):
+    """
+    Return a pooled database for the engine in config, either postgres, sqlite or memory.
+    """
+    pool = dict(max_connections=config['max_connections'],
+                stale_timeout=config['stale_timeout'],
+                timeout=config['pool_timeout'],
+                autorollback=config['autorollback'])
+
+    if config['engine'] == 'sqlite':
+        return PooledSqliteDatabase(config['db_name'],
+                                    pragmas={'foreign_keys': 1, 'journal_mode': 'wal'},
+                                    check_same_thread=False,
+                                    **pool)
+
+    if config['engine'] == 'memory':
+        # Connections to a named in-memory database with a shared cache see the same database, which lasts while one
+        # is open. The pool keeps them open.
+        return PooledSqliteDatabase(f"file:{config['db_name']}?mode=memory&cache=shared",
+                                    uri=True,
+                                    pragmas={'foreign_keys': 1},
+                                    check_same_thread=False,
+                                    **dict(pool, stale_timeout=None))
+
+    if config['engine'] == 'postgres':
+        return PooledPostgresqlDatabase(config['db_name'],
+                                        user=config['user'],
+                                        password=config['password'],
+                                        host=config['host'],
+                                        port=config['port'],
+                                        **pool)
+
+    raise ValueError(f"Unsupported database engine: {config['engine']}")
+
+
+def create_replica(config, address):
+    """
+    Return a pooled database for a replica of the database in config at address, host[:port][/db_name] on PostgreSQL
+    or a database file or in-memory database name on SQLite.
+    """
+    if config['engine'] in ('sqlite', 'memory'):
+        return create_database(dict(config, db_name=address))
+
+    address, _, db_name = address.partition('/')
+    host, _, port = address.partition(':')
+    return create_database(dict(config, db_name=db_name or config['db_name'], host=host,
+                                port=int(port or config['port'])))
+
+
+db = create_database(settings.DATABASE)
+replicas = [create_replica(settings.DATABASE, address) for address in settings.DATABASE_REPLICAS]
+
+_routing = threading.local()
+
+
+class RoutedMetadata(Metadata):
+    """
+    Model metadata whose database can be replaced in the current thread, so a request can read from a replica.
+    """
+
+    @property
+    def database(self):
+        return getattr(_routing, 'database', None) or self._database
+
+    @database.setter
+    def database(self, database):
+        self._database = database
+
+
+def choose_replica():
+    """
+    Return a random replica, or None if there are none.
+    """
+    return random.choice(replicas) if replicas else None
+
+
+def use_database(database):
+    """
+    Run the queries of the models in the current thread on database, or on db if None. Return the previous database.
+    """
+    previous = getattr(_routing, 'database', None)
+    _routing.database = database
+    return previous
+
+
+@contextmanager
+def using(database):
+    """
+    Run the queries of the models in the block on database in the current thread.
+    """
+    previous = use_database(database)
+    try:
+        yield database
+    finally:
+        use_database(previous)
 
 
 # ORM Classes
 class Person(Model):
     class Meta:
         database = db
-        table_name = settings.PERSON_TABLE + ('_TEST' if os.environ.get('TEST') else '')
+        model_metadata_class = RoutedMetadata
+        table_name = settings.PERSON_TABLE + settings.TABLE_SUFFIX
 
     first_name = TextField(column_name='first_name')
     last_name = TextField(column_name='last_name')
-    partner = ForeignKeyField('self', null=True, backref='partners', column_name='partner')
+    partner = ForeignKeyField('self', null=True, backref='partners', column_name='partner', index=False)
 
 
 class Pet(Model):
     class Meta:
         database = db
-        table_name = settings.PET_TABLE + ('_TEST' if os.environ.get('TEST') else '')
+        model_metadata_class = RoutedMetadata
+        table_name = settings.PET_TABLE + settings.TABLE_SUFFIX
 
     name = TextField(column_name='name')
-    owner = ForeignKeyField(Person, null=True, backref='pets', column_name='owner')
+    owner = ForeignKeyField(Person, null=True, backref='pets', column_name='owner', index=False)
+
+
+# Indexes are named after their table so the test tables can share a schema.
+# A person can be the partner of only one person.
+Person.add_index(Person.index(Person.partner, unique=True, name=f'{Person._meta.table_name}_partner'))
+# Married persons ordered by id.
+Person.add_index(Person.index(Person.id, where=SQL('partner IS NOT NULL'),
+                              name=f'{Person._meta.table_name}_married_id'))
+# Pets of an owner ordered by id, also used to reassign pets when a person is removed.
+Pet.add_index(Pet.index(Pet.owner, Pet.id, name=f'{Pet._meta.table_name}_owner_id'))
+# Pets of null owner ordered by id.
+Pet.add_index(Pet.index(Pet.id, where=SQL('owner IS NULL'), name=f'{Pet._meta.table_name}_null_owner_id'))
+# Case-insensitive name searches ordered by id. On PostgreSQL the pattern operator class lets LIKE match prefixes.
+_LOWER = 'lower({}) text_pattern_ops' if isinstance(db, PostgresqlDatabase) else 'lower({})'
+Person.add_index(Person.index(SQL(_LOWER.format('first_name')), Person.id,
+                              name=f'{Person._meta.table_name}_lower_first_name_id'))
+Person.add_index(Person.index(SQL(_LOWER.format('last_name')), Person.id,
+                              name=f'{Person._meta.table_name}_lower_last_name_id'))
+Pet.add_index(Pet.index(SQL(_LOWER.format('name')), Pet.id, name=f'{Pet._meta.table_name}_lower_name_id'))
+
+
+class Counter(Model):
+    class Meta:
+        database = db
+        model_metadata_class = RoutedMetadata
+        table_name = settings.COUNTER_TABLE + settings.TABLE_SUFFIX
+
+    name = TextField(column_name='name', primary_key=True)
+    value = BigIntegerField(column_name='value', default=0)
+
+
+class Change(Model):
+    class Meta:
+        database = db
+        model_metadata_class = RoutedMetadata
+        table_name = settings.CHANGE_TABLE + settings.TABLE_SUFFIX
+
+    seq = BigIntegerField(column_name='seq', primary_key=True)
+    entity = TextField(column_name='entity')
+    entity_id = BigIntegerField(column_name='entity_id')
+    action = TextField(column_name='action')
+    # JSON of the entity after the change, with the id of its partner or owner, or null if it was removed
+    data = TextField(column_name='data', null=True)
+
+
+class Job(Model):
+    class Meta:
+        database = db
+        model_metadata_class = RoutedMetadata
+        table_name = settings.JOB_TABLE + settings.TABLE_SUFFIX
+
+    kind = TextField(column_name='kind')
+    # pending, running, done or failed
+    status = TextField(column_name='status', default='pending')
+    # JSON list of the ids of the items to process
+    items = TextField(column_name='items')
+    total = IntegerField(column_name='total')
+    # Items processed by committed batches, where a retry resumes
+    processed = IntegerField(column_name='processed', default=0)
+    rows_removed = IntegerField(column_name='rows_removed', default=0)
+    attempts = IntegerField(column_name='attempts', default=0)
+    error = TextField(column_name='error', null=True)
+    # Time in seconds since the epoch after which another worker can take over a running job
+    lease_expires = DoubleField(column_name='lease_expires', null=True)
+
+
+# Unfinished jobs, found when resuming them.
+Job.add_index(Job.index(Job.id, where=SQL("status IN ('pending', 'running')"),
+                        name=f'{Job._meta.table_name}_unfinished_id'))
+
+
+# Queries
+def match_text(field, value):
+    """
+    Return a condition matching a text field case-insensitively, by prefix if value ends with *, that can use an
+    index on the lower() of the field.
+    """
+    if not value.endswith('*'):
+        return fn.LOWER(field) == fn.LOWER(value)
+
+    prefix = value[:-1]
+    if isinstance(db, PostgresqlDatabase):
+        pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        return Expression(fn.LOWER(field), OP.LIKE, fn.LOWER(pattern))
+
+    # Strings starting with the prefix sort between it and the prefix followed by the greatest code point.
+    return (fn.LOWER(field) >= fn.LOWER(prefix)) & (fn.LOWER(field) < fn.LOWER(prefix).concat('\U0010ffff'))
+
+
+def match_married(married):
+    """
+    Return a condition on whether persons are married. NULL is written literally, as a parameter would keep SQLite
+    from using the index of married persons.
+    """
+    return Expression(Person.partner, OP.IS_NOT if married else OP.IS, SQL('NULL'))
+
+
+def transaction():
+    """
+    Return an atomic block for writes. SQLite takes the write lock when it begins so concurrent writers queue
+    instead of failing to upgrade a read lock.
+    """
+    if isinstance(db, SqliteDatabase):
+        return db.atomic('IMMEDIATE')
+
+    return db.atomic()
+
+
+def select_for_update(query):
+    """
+    Return the query locking its rows until the end of the transaction where the database supports it.
+    """
+    if db.for_update:
+        return query.for_update()
+
+    return query
+
+
+def insert_many(model, rows):
+    """
+    Insert rows with multi-row INSERTs and return the created ids in order.
+    """
+    database = model._meta.database
+    ids = []
+    for batch in chunked(rows, settings.BULK_INSERT_BATCH_SIZE):
+        query = model.insert_many(batch)
+        if database.returning_clause:
+            ids.extend(row[0] for row in query.returning(model.id).tuples().execute())
+        else:
+            # SQLite serializes writes so a multi-row INSERT gets contiguous ids ending at the last row id.
+            last_id = database.execute(query).lastrowid
+            ids.extend(range(last_id - len(batch) + 1, last_id + 1))
+
+    return ids
+
+
+def describe_change(instance, action, **data):
+    """
+    Return the change of a person or pet for record_change, with data overriding its fields.
+    """
+    return instance._meta.name, instance.id, action, dict(model_to_dict(instance, recurse=False), **data)
+
+
+def count_pets(*owner_ids):
+    """
+    Return the number of pets of each owner in owner_ids that has pets.
+    """
+    query = Pet.select(Pet.owner, fn.COUNT(Pet.id)).where(Pet.owner.in_(owner_ids)).group_by(Pet.owner)
+    return dict(query.tuples())
+
+
+def count_owner(counters, pet_count, new_pet_count):
+    """
+    Add to counters an owner going from pet_count to new_pet_count pets. owners:<n> counts the persons with n pets,
+    for n of at least 1.
+    """
+    if pet_count != new_pet_count:
+        for count, delta in [(pet_count, -1), (new_pet_count, 1)]:
+            if count:
+                counters[f'owners:{count}'] = counters.get(f'owners:{count}', 0) + delta
+
+
+def record_change(*changes, counters=None):
+    """
+    Increment the change counter, which versions every list, add counters to the stats counters, and append changes
+    to the change log. Each change is a tuple of entity, entity id, action and data, and gets the next value of the
+    change counter as its sequence number. The counter rows stay locked until the transaction ends, so changes are
+    committed in sequence order.
+    """
+    if not changes:
+        return
+
+    # Rows are upserted in name order so concurrent transactions lock them in the same order.
+    counters = dict(counters or {}, changes=len(changes))
+    rows = [dict(name=name, value=value) for name, value in sorted(counters.items()) if value]
+    query = (Counter
+             .insert_many(rows)
+             .on_conflict(conflict_target=[Counter.name], update={Counter.value: Counter.value + EXCLUDED.value}))
+    if db.returning_clause:
+        last_seq = dict(query.returning(Counter.name, Counter.value).tuples().execute())['changes']
+    else:
+        query.execute()
+        last_seq = Counter.select(Counter.value).where(Counter.name == 'changes').scalar()
+
+    first_seq = last_seq - len(changes) + 1
+    rows = [dict(seq=first_seq + index, entity=entity, entity_id=entity_id, action=action,
+                 data=None if data is None else json.dumps(data, sort_keys=True))
+            for index, (entity, entity_id, action, data) in enumerate(changes)]
+    for batch in chunked(rows, settings.BULK_INSERT_BATCH_SIZE):
+        Change.insert_many(batch).execute()
+
+
+def rebuild_counters():
+    """
+    Recompute the stats counters from the tables, such as after an upgrade. The change counter is locked first, like
+    every mutation does, so the mutations committed afterwards add to the recomputed values.
+    """
+    with transaction():
+        (Counter
+         .insert(name='changes', value=0)
+         .on_conflict(conflict_target=[Counter.name], update={Counter.value: Counter.value})
+         .execute())
+
+        owners = (Pet
+                  .select(fn.COUNT(Pet.id).alias('pet_count'))
+                  .where(Pet.owner.is_null(False))
+                  .group_by(Pet.owner)
+                  .alias('owners'))
+        histogram = (Select([owners], [owners.c.pet_count, fn.COUNT(SQL('*'))])
+                     .group_by(owners.c.pet_count)
+                     .bind(Pet._meta.database))
+
+        counters = {
+            'persons': Person.select().count(),
+            'married_pairs': Person.select().where(match_married(True)).count() // 2,
+            'pets': Pet.select().count(),
+            'unowned_pets': Pet.select().where(Pet.owner.is_null()).count(),
+        }
+        counters.update((f'owners:{pet_count}', count) for pet_count, count in histogram.tuples())
+
+        Counter.delete().where(Counter.name.startswith('owners:')).execute()
+        rows = [dict(name=name, value=value) for name, value in sorted(counters.items())]
+        (Counter
+         .insert_many(rows)
+         .on_conflict(conflict_target=[Counter.name], update={Counter.value: EXCLUDED.value})
+         .execute())
+
+
+def get_stats():
+    """
+    Return the stats counters: the number of persons, married pairs, pets and pets of null owner, and the number of
+    persons with each number of pets.
+    """
+    counters = dict(Counter.select(Counter.name, Counter.value).where(Counter.name != 'changes').tuples())
+    pets_per_person = {int(name[len('owners:'):]): value for name, value in counters.items()
+                       if name.startswith('owners:') and value}
+    persons = counters.get('persons', 0)
+    pets_per_person[0] = persons - sum(pets_per_person.values())
+    return {
+        'persons': persons,
+        'married_pairs': counters.get('married_pairs', 0),
+        'pets': counters.get('pets', 0),
+        'unowned_pets': counters.get('unowned_pets', 0),
+        'pets_per_person': [{'pets': pets, 'persons': count} for pets, count in sorted(pets_per_person.items())],
+    }
+
+
+def get_version():
+    """
+    Return the change counter, which every mutation increments, by its primary key. It versions every list, however
+    large the tables grow.
+    """
+    return Counter.select(Counter.value).where(Counter.name == 'changes').scalar()
 
 
 # Custom Exceptions
@@ -52,3 +413,15 @@ class InvalidRequestException(Exception):
 
 class InternalServerErrorException(Exception):
     pass
+
+
+class TooManyRequestsException(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ServiceUnavailableException(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
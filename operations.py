@@ -0,0 +1,481 @@
+from collections import defaultdict
+
+from peewee import Case
+from playhouse.shortcuts import model_to_dict
+
+from cache import deferred_invalidation, invalidate_persons, invalidate_pets
+from models import (db, Person, Pet, select_for_update, insert_many, count_owner, count_pets, describe_change,
+                    record_change, transaction, InvalidRequestException, NotFoundException, ConflictException)
+
+
+def is_id(value):
+    """
+    Return whether a value of a JSON body is an integer id. JSON true and false are bools, which are ints in Python.
+    """
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _lock_persons(*person_ids):
+    """
+    Return the persons with person_ids by id, locked in id order so concurrent writers cannot deadlock.
+    """
+    query = Person.select().where(Person.id.in_(person_ids)).order_by(Person.id)
+    return {person.id: person for person in select_for_update(query)}
+
+
+class Lookups:
+    """
+    Persons locked and pet counts read in a transaction. The operations of a batch share them so that each row is
+    looked up once, and keep them up to date with their writes.
+    """
+
+    def __init__(self):
+        self.persons = {}
+        self.pet_counts = {}
+
+    def lock_persons(self, *person_ids):
+        """
+        Return the persons with person_ids by id, locking those not locked yet like _lock_persons.
+        """
+        missing = set(person_ids) - set(self.persons) - {None}
+        if missing:
+            self.persons.update(_lock_persons(*missing))
+
+        return {person_id: self.persons[person_id] for person_id in person_ids if person_id in self.persons}
+
+    def count_pets(self, *owner_ids):
+        """
+        Return the number of pets of each owner in owner_ids.
+        """
+        missing = set(owner_ids) - set(self.pet_counts)
+        if missing:
+            pet_counts = count_pets(*missing)
+            self.pet_counts.update((owner_id, pet_counts.get(owner_id, 0)) for owner_id in missing)
+
+        return {owner_id: self.pet_counts[owner_id] for owner_id in owner_ids}
+
+    def add(self, person):
+        """
+        Add a person created in the transaction, which has no pets yet.
+        """
+        self.persons[person.id] = person
+        self.pet_counts[person.id] = 0
+
+    def remove(self, person_id):
+        """
+        Remove a person deleted in the transaction.
+        """
+        self.persons.pop(person_id, None)
+        self.pet_counts.pop(person_id, None)
+
+
+def _marry(person_id, partner_id):
+    """
+    Set the partner of a person, unless the person is already married.
+    """
+    married = Person.update(partner=partner_id).where(Person.id == person_id, Person.partner.is_null()).execute()
+    if married == 0:
+        raise ConflictException('Partner already married')
+
+
+def create_person(first_name, last_name, partner_id=None, lookups=None):
+    """
+    Create a person and marries partners if eligible.
+    """
+    lookups = lookups or Lookups()
+    if first_name is None:
+        raise InvalidRequestException('First name is required')
+
+    if last_name is None:
+        raise InvalidRequestException('Last name is required')
+
+    if partner_id is not None and not is_id(partner_id):
+        raise InvalidRequestException('Partner id must be an integer')
+
+    with transaction():
+        partner = None
+        if partner_id is not None:
+            partner = lookups.lock_persons(partner_id).get(partner_id)
+            if partner is None:
+                raise NotFoundException('Partner not found')
+            if partner.partner_id is not None:
+                raise ConflictException('Partner already married')
+
+        result = Person.create(first_name=first_name, last_name=last_name, partner=partner)
+        lookups.add(result)
+
+        changes = [describe_change(result, 'created')]
+        counters = {'persons': 1}
+        if partner is not None:
+            _marry(partner.id, result.id)
+            partner.partner = result
+            changes.append(describe_change(partner, 'updated'))
+            counters['married_pairs'] = 1
+
+        record_change(*changes, counters=counters)
+
+    invalidate_persons(result.id, partner_id)
+    return result
+
+
+def create_persons(items):
+    """
+    Create persons from items in one transaction and marries partners if eligible. Return the created person, or the
+    exception that failed it, of each item in order.
+    """
+    results = [None] * len(items)
+
+    persons = []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise InvalidRequestException('Item must be an object')
+
+            first_name = item.get('first_name')
+            last_name = item.get('last_name')
+            partner_id = item.get('partner_id')
+
+            if first_name is None:
+                raise InvalidRequestException('First name is required')
+
+            if last_name is None:
+                raise InvalidRequestException('Last name is required')
+
+            if partner_id is not None and not is_id(partner_id):
+                raise InvalidRequestException('Partner id must be an integer')
+
+            persons.append((index, Person(first_name=first_name, last_name=last_name, partner=partner_id)))
+        except Exception as e:
+            results[index] = e
+
+    with transaction():
+        partner_ids = [person.partner_id for _, person in persons if person.partner_id is not None]
+        partners = _lock_persons(*partner_ids) if partner_ids else {}
+
+        valid_persons = []
+        married_ids = set()
+        for index, person in persons:
+            try:
+                if person.partner_id is not None:
+                    partner = partners.get(person.partner_id)
+                    if partner is None:
+                        raise NotFoundException('Partner not found')
+                    if partner.partner_id is not None or partner.id in married_ids:
+                        raise ConflictException('Partner already married')
+
+                    married_ids.add(partner.id)
+                    person.partner = partner
+
+                valid_persons.append((index, person))
+            except Exception as e:
+                results[index] = e
+
+        rows = [dict(first_name=person.first_name, last_name=person.last_name, partner=person.partner_id)
+                for _, person in valid_persons]
+        for (_, person), result_id in zip(valid_persons, insert_many(Person, rows)):
+            person.id = result_id
+
+        marriages = [(person.partner_id, person.id) for _, person in valid_persons if person.partner_id is not None]
+        if marriages:
+            married = (Person
+                       .update(partner=Case(Person.id, marriages))
+                       .where(Person.id.in_([partner_id for partner_id, _ in marriages]), Person.partner.is_null())
+                       .execute())
+            if married != len(marriages):
+                raise ConflictException('Partner already married')
+
+        changes = [describe_change(person, 'created') for _, person in valid_persons]
+        changes.extend(describe_change(person.partner, 'updated', partner=person.id)
+                       for _, person in valid_persons if person.partner_id is not None)
+        record_change(*changes, counters={'persons': len(valid_persons), 'married_pairs': len(marriages)})
+
+    invalidate_persons(*[person.partner_id for _, person in valid_persons])
+
+    for index, person in valid_persons:
+        results[index] = person
+
+    return results
+
+
+def update_person(person_id, first_name=None, last_name=None, partner_id=None, lookups=None):
+    """
+    Update a person and marries partners if eligible.
+    """
+    lookups = lookups or Lookups()
+    if partner_id is not None and not is_id(partner_id):
+        raise InvalidRequestException('Partner id must be an integer')
+
+    with transaction():
+        persons = lookups.lock_persons(person_id, partner_id)
+        result = persons.get(person_id)
+        if result is None:
+            raise NotFoundException('Person not found')
+
+        if first_name is not None:
+            result.first_name = first_name
+
+        if last_name is not None:
+            result.last_name = last_name
+
+        partner = None
+        if result.partner_id is not None:
+            partner = lookups.persons.get(result.partner_id) or Person.get_by_id(result.partner_id)
+
+        marry = partner_id is not None and partner is None
+        if partner_id is not None:
+            if partner is None:
+                partner = persons.get(partner_id)
+                if partner is None:
+                    raise NotFoundException('Partner not found')
+                if partner.partner_id is not None:
+                    raise ConflictException('Partner already married')
+
+            if partner_id != partner.id:
+                raise InvalidRequestException('Partner does not match partner_id')
+
+        changes = []
+        counters = {}
+        if marry:
+            _marry(partner.id, result.id)
+            result.partner = partner
+            partner.partner = result
+            changes.append(describe_change(partner, 'updated'))
+            counters['married_pairs'] = 1
+
+        result.save()
+        record_change(describe_change(result, 'updated'), *changes, counters=counters)
+
+    result.partner = partner
+    invalidate_persons(result.id, result.partner_id)
+    return result
+
+
+def remove_person(person_id, lookups=None):
+    """
+    Remove a person and transfers pets to partner or null partner if not married. Return the number of rows removed.
+    """
+    return remove_persons([person_id], lookups=lookups)
+
+
+def remove_persons(person_ids, progress=None, lookups=None):
+    """
+    Remove persons like remove_person in one transaction, locking them and their partners first. progress, if given,
+    is called with the number of rows removed before the transaction commits. Return the number of rows removed.
+    """
+    lookups = lookups or Lookups()
+    with transaction():
+        # The partners of persons not locked yet are read first, so that they are locked together in id order.
+        locked = [lookups.persons[person_id] for person_id in person_ids if person_id in lookups.persons]
+        partner_ids = [person.partner_id for person in locked]
+        unlocked_ids = [person_id for person_id in person_ids if person_id not in lookups.persons]
+        if unlocked_ids:
+            query = Person.select(Person.partner).where(Person.id.in_(unlocked_ids), Person.partner.is_null(False))
+            partner_ids.extend(partner_id for partner_id, in query.tuples())
+
+        persons = lookups.lock_persons(*person_ids, *partner_ids)
+        # Partners married since they were read are locked after the others.
+        partner_ids = {persons[person_id].partner_id for person_id in person_ids if person_id in persons}
+        partner_ids -= set(persons) | {None}
+        if partner_ids:
+            persons.update(lookups.lock_persons(*partner_ids))
+
+        # Pets of the partners, which get the pets of the persons removed.
+        pet_counts = lookups.pet_counts
+        lookups.count_pets(*{person.partner_id for person in persons.values()} - {None})
+
+        rows_removed = 0
+        changes = []
+        counters = defaultdict(int)
+        invalidated_person_ids = []
+        pet_ids = []
+        for person_id in person_ids:
+            result = persons.pop(person_id, None)
+            if result is None:
+                continue
+
+            pets = Pet.update(owner=result.partner_id).where(Pet.owner == person_id)
+            if db.returning_clause:
+                pet_rows = list(pets.returning(Pet.id, Pet.name).tuples().execute())
+            else:
+                pet_rows = list(Pet.select(Pet.id, Pet.name).where(Pet.owner == person_id).tuples())
+                pets.execute()
+
+            changes.append(('person', person_id, 'removed', None))
+            changes.extend(('pet', pet_id, 'updated', {'id': pet_id, 'name': name, 'owner': result.partner_id})
+                           for pet_id, name in pet_rows)
+            pet_ids.extend(pet_id for pet_id, _ in pet_rows)
+            count_owner(counters, len(pet_rows), 0)
+
+            if result.partner_id is not None:
+                Person.update(partner=None).where(Person.id == result.partner_id).execute()
+                partner = persons[result.partner_id]
+                partner.partner = None
+                changes.append(describe_change(partner, 'updated'))
+
+                partner_pet_count = pet_counts[partner.id]
+                pet_counts[partner.id] = partner_pet_count + len(pet_rows)
+                count_owner(counters, partner_pet_count, pet_counts[partner.id])
+                counters['married_pairs'] -= 1
+            else:
+                counters['unowned_pets'] += len(pet_rows)
+
+            rows_removed += Person.delete().where(Person.id == person_id).execute()
+            lookups.remove(person_id)
+            counters['persons'] -= 1
+            invalidated_person_ids.extend([person_id, result.partner_id])
+
+        record_change(*changes, counters=counters)
+        if progress is not None:
+            progress(rows_removed)
+
+    invalidate_persons(*invalidated_person_ids)
+    invalidate_pets(*pet_ids)
+    return rows_removed
+
+
+def create_pet(person_id, name, lookups=None):
+    """
+    Create a pet for an existing owner.
+    """
+    lookups = lookups or Lookups()
+    with transaction():
+        # The owner stays locked so concurrent creates count its pets in turn.
+        owner = lookups.lock_persons(person_id).get(person_id)
+        if owner is None:
+            raise NotFoundException('Owner not found')
+
+        if name is None:
+            raise InvalidRequestException('Name is required')
+
+        pet_count = lookups.count_pets(person_id)[person_id]
+        result = Pet.create(name=name, owner=owner)
+        lookups.pet_counts[person_id] = pet_count + 1
+
+        counters = {'pets': 1}
+        count_owner(counters, pet_count, pet_count + 1)
+        record_change(describe_change(result, 'created'), counters=counters)
+
+    invalidate_pets(result.id)
+    return result
+
+
+def create_pets(person_id, items):
+    """
+    Create pets from items in one transaction for an existing owner. Return the created pet, or the exception that
+    failed it, of each item in order.
+    """
+    results = [None] * len(items)
+
+    pets = []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise InvalidRequestException('Item must be an object')
+
+            name = item.get('name')
+            if name is None:
+                raise InvalidRequestException('Name is required')
+
+            pets.append((index, Pet(name=name)))
+        except Exception as e:
+            results[index] = e
+
+    with transaction():
+        # The owner stays locked so concurrent creates count its pets in turn.
+        owner = _lock_persons(person_id).get(person_id)
+        if owner is None:
+            raise NotFoundException('Owner not found')
+
+        pet_count = count_pets(owner.id).get(owner.id, 0)
+
+        rows = [dict(name=pet.name, owner=owner) for _, pet in pets]
+        for (_, pet), result_id in zip(pets, insert_many(Pet, rows)):
+            pet.id = result_id
+            pet.owner = owner
+
+        counters = {'pets': len(pets)}
+        count_owner(counters, pet_count, pet_count + len(pets))
+        record_change(*[describe_change(pet, 'created') for _, pet in pets], counters=counters)
+
+    invalidate_pets(*[pet.id for _, pet in pets])
+
+    for index, pet in pets:
+        results[index] = pet
+
+    return results
+
+
+def _resolve(value, refs):
+    """
+    Return the id created by an earlier batch item if value is $ followed by its ref, or else value.
+    """
+    if isinstance(value, str) and value.startswith('$'):
+        if value[1:] not in refs:
+            raise InvalidRequestException(f'Unknown reference {value}')
+        return refs[value[1:]]
+
+    return value
+
+
+def _run_batch_item(item, refs, lookups):
+    """
+    Run the operation of a batch item with the lookups of the batch and return its result.
+    """
+    if not isinstance(item, dict):
+        raise InvalidRequestException('Item must be an object')
+
+    op = item.get('op')
+    if op not in ('create_person', 'update_person', 'remove_person', 'create_pet'):
+        raise InvalidRequestException(f'Unsupported op: {op}')
+
+    body = item.get('body', {})
+    if not isinstance(body, dict):
+        raise InvalidRequestException('Body must be an object')
+
+    person_id = _resolve(item.get('person_id'), refs)
+    if op != 'create_person' and not is_id(person_id):
+        raise InvalidRequestException('Person id must be an integer')
+
+    partner_id = _resolve(body.get('partner_id'), refs)
+
+    if op == 'create_person':
+        return create_person(body.get('first_name'), body.get('last_name'), partner_id, lookups)
+
+    if op == 'update_person':
+        return update_person(person_id, body.get('first_name'), body.get('last_name'), partner_id, lookups)
+
+    if op == 'remove_person':
+        return remove_person(person_id, lookups)
+
+    return create_pet(person_id, body.get('name'), lookups)
+
+
+def run_batch(items):
+    """
+    Run the operations of batch items in order in one transaction and return the op and result of each: the number of
+    rows removed, or the dict of the person or pet as the item left it. An item has an op of create_person,
+    update_person, remove_person or create_pet, the person_id it applies to and the body of the matching endpoint. It
+    can name the id it creates with a ref, which later items pass as person_id or partner_id prefixed with $. If an
+    item fails, none is applied and the exception is raised with the index of the item.
+    """
+    results = []
+    refs = {}
+    # The items share the persons they lock and the pets they count, so each is read once per batch.
+    lookups = Lookups()
+    with deferred_invalidation(), transaction():
+        for index, item in enumerate(items):
+            try:
+                result = _run_batch_item(item, refs, lookups)
+                ref = item.get('ref')
+                if ref is not None:
+                    if item['op'] not in ('create_person', 'create_pet') or not isinstance(ref, str):
+                        raise InvalidRequestException('Ref must be a string naming a created person or pet')
+                    refs[ref] = result.id
+            except Exception as e:
+                e.index = index
+                raise
+
+            # The items share their persons, so each is serialized before later items change it.
+            results.append((item['op'], result if item['op'] == 'remove_person' else model_to_dict(result)))
+
+    return results
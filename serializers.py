@@ -0,0 +1,169 @@
+from json.encoder import encode_basestring_ascii
+
+from peewee import JOIN
+
+from models import Change, Person, Pet
+
+# Rows select only the columns of the JSON representation, so they can be encoded without building models or dicts.
+# The templates reproduce flask.json.dumps of model_to_dict byte for byte: sorted keys, ', ' and ': ' separators and
+# non-ASCII characters escaped.
+_PARTNER_JSON = '{"first_name": %s, "id": %d, "last_name": %s}'
+_PERSON_JSON = '{"first_name": %s, "id": %d, "last_name": %s, "partner": %s}'
+_PET_JSON = '{"id": %d, "name": %s, "owner": %s}'
+# The compact format has the id of the partner and owner instead of their object. The columnar format has a list of
+# column names and a list per row with the values of the compact format, so keys are not repeated on every row.
+_PERSON_ROW_JSON = '[%d, %s, %s, %s]'
+_PET_ROW_JSON = '[%d, %s, %s]'
+PERSON_COLUMNS = ['id', 'first_name', 'last_name', 'partner']
+PET_COLUMNS = ['id', 'name', 'owner']
+_CHANGE_JSON = '{"action": %s, "data": %s, "entity": %s, "id": %d, "seq": %d}'
+
+
+def select_person_rows():
+    """
+    Return a query of person rows: id, first_name, last_name and the partner's id, first_name and last_name.
+    """
+    partner = Person.alias()
+    return (Person
+            .select(Person.id, Person.first_name, Person.last_name, partner.id, partner.first_name, partner.last_name)
+            .join(partner, JOIN.LEFT_OUTER, on=(Person.partner == partner.id))
+            .tuples())
+
+
+def select_pet_rows():
+    """
+    Return a query of pet rows: id, name and the owner's person row.
+    """
+    partner = Person.alias()
+    return (Pet
+            .select(Pet.id, Pet.name, Person.id, Person.first_name, Person.last_name,
+                    partner.id, partner.first_name, partner.last_name)
+            .join(Person, JOIN.LEFT_OUTER, on=(Pet.owner == Person.id))
+            .join(partner, JOIN.LEFT_OUTER, on=(Person.partner == partner.id))
+            .tuples())
+
+
+def person_row_to_dict(row):
+    """
+    Return the person of a person row as model_to_dict would.
+    """
+    person_id, first_name, last_name, partner_id, partner_first_name, partner_last_name = row
+    partner = None
+    if partner_id is not None:
+        partner = {'id': partner_id, 'first_name': partner_first_name, 'last_name': partner_last_name}
+
+    return {'id': person_id, 'first_name': first_name, 'last_name': last_name, 'partner': partner}
+
+
+def encode_person_row(row):
+    """
+    Return the JSON of a person row.
+    """
+    person_id, first_name, last_name, partner_id, partner_first_name, partner_last_name = row
+    partner = 'null'
+    if partner_id is not None:
+        partner = _PARTNER_JSON % (encode_basestring_ascii(partner_first_name), partner_id,
+                                   encode_basestring_ascii(partner_last_name))
+
+    return _PERSON_JSON % (encode_basestring_ascii(first_name), person_id, encode_basestring_ascii(last_name), partner)
+
+
+def encode_pet_row(row):
+    """
+    Return the JSON of a pet row.
+    """
+    owner = 'null' if row[2] is None else encode_person_row(row[2:])
+    return _PET_JSON % (row[0], encode_basestring_ascii(row[1]), owner)
+
+
+def _encode_id(value):
+    return 'null' if value is None else '%d' % value
+
+
+def encode_person_row_compact(row):
+    """
+    Return the JSON of a person row with the id of the partner.
+    """
+    return _PERSON_JSON % (encode_basestring_ascii(row[1]), row[0], encode_basestring_ascii(row[2]), _encode_id(row[3]))
+
+
+def encode_pet_row_compact(row):
+    """
+    Return the JSON of a pet row with the id of the owner.
+    """
+    return _PET_JSON % (row[0], encode_basestring_ascii(row[1]), _encode_id(row[2]))
+
+
+def encode_person_row_columnar(row):
+    """
+    Return the JSON list of the PERSON_COLUMNS of a person row.
+    """
+    return _PERSON_ROW_JSON % (row[0], encode_basestring_ascii(row[1]), encode_basestring_ascii(row[2]),
+                               _encode_id(row[3]))
+
+
+def encode_pet_row_columnar(row):
+    """
+    Return the JSON list of the PET_COLUMNS of a pet row.
+    """
+    return _PET_ROW_JSON % (row[0], encode_basestring_ascii(row[1]), _encode_id(row[2]))
+
+
+PERSON_ENCODERS = {'full': encode_person_row, 'compact': encode_person_row_compact,
+                   'columnar': encode_person_row_columnar}
+PET_ENCODERS = {'full': encode_pet_row, 'compact': encode_pet_row_compact, 'columnar': encode_pet_row_columnar}
+
+
+def select_change_rows(since):
+    """
+    Return a query of change rows after the sequence number since, in sequence order: seq, entity, entity id, action
+    and data.
+    """
+    return (Change
+            .select(Change.seq, Change.entity, Change.entity_id, Change.action, Change.data)
+            .where(Change.seq > since)
+            .order_by(Change.seq)
+            .tuples())
+
+
+def encode_change_row(row):
+    """
+    Return the JSON of a change row. Its data is stored as JSON.
+    """
+    seq, entity, entity_id, action, data = row
+    return _CHANGE_JSON % (encode_basestring_ascii(action), 'null' if data is None else data,
+                           encode_basestring_ascii(entity), entity_id, seq)
+
+
+def select_household_rows(person_id):
+    """
+    Return a query of the person row of a person joined to the id, name and owner of each pet of the person and
+    their partner, newest pet first. The person row is joined to nulls if neither has pets.
+    """
+    partner = Person.alias()
+    return (Person
+            .select(Person.id, Person.first_name, Person.last_name, partner.id, partner.first_name, partner.last_name,
+                    Pet.id, Pet.name, Pet.owner)
+            .join(partner, JOIN.LEFT_OUTER, on=(Person.partner == partner.id))
+            .join(Pet, JOIN.LEFT_OUTER, on=((Pet.owner == Person.id) | (Pet.owner == partner.id)))
+            .where(Person.id == person_id)
+            .order_by(Pet.id.desc())
+            .tuples())
+
+
+def household_rows_to_dict(rows):
+    """
+    Return the person, the partner and the pets of each from household rows.
+    """
+    person_row = rows[0][:6]
+    partner = None
+    if person_row[3] is not None:
+        partner = person_row_to_dict(person_row[3:] + person_row[:3])
+
+    pets = []
+    partner_pets = []
+    for row in rows:
+        if row[6] is not None:
+            (pets if row[8] == person_row[0] else partner_pets).append({'id': row[6], 'name': row[7]})
+
+    return {'person': person_row_to_dict(person_row), 'partner': partner, 'pets': pets, 'partner_pets': partner_pets}
@@ -1,12 +1,103 @@
+import os
+
 DATABASE = {
-    'db_name': 'test',
-    'user': 'postgres',
-    'password': 'admin',
-    'host': 'localhost',
-    'port': 5432,
-    'autorollback': True
+    'engine': os.environ.get('DATABASE_ENGINE', 'postgres'),
+    'db_name': os.environ.get('DATABASE_NAME', 'test'),
+    'user': os.environ.get('DATABASE_USER', 'postgres'),
+    'password': os.environ.get('DATABASE_PASSWORD', 'admin'),
+    'host': os.environ.get('DATABASE_HOST', 'localhost'),
+    'port': int(os.environ.get('DATABASE_PORT', 5432)),
+    'autorollback': True,
+    # Connection pool
+    'max_connections': int(os.environ.get('DATABASE_MAX_CONNECTIONS', 20)),
+    'stale_timeout': int(os.environ.get('DATABASE_STALE_TIMEOUT', 300)),
+    'pool_timeout': int(os.environ.get('DATABASE_POOL_TIMEOUT', 10))
+}
+
+# Read replicas of DATABASE serving GET requests: comma separated host[:port][/db_name] on PostgreSQL, or database
+# files on SQLite. Replication itself is left to the database.
+DATABASE_REPLICAS = [address for address in os.environ.get('DATABASE_REPLICAS', '').split(',') if address]
+# Seconds after a client's last write during which its GET requests read from the primary, so it reads its writes
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+
+CACHE = {
+    # memory (per process), redis (shared, requires the redis package) or none
+    'backend': os.environ.get('CACHE_BACKEND', 'memory'),
+    'url': os.environ.get('CACHE_URL', 'redis://localhost:6379/0'),
+    'max_size': int(os.environ.get('CACHE_MAX_SIZE', 10000)),
+    'ttl': int(os.environ.get('CACHE_TTL', 60))
+}
+
+METRICS = {
+    # Statements slower than this are logged as warnings
+    'slow_query_ms': float(os.environ.get('SLOW_QUERY_MS', 100)),
+    # Requests sending this header get their timings back in a Server-Timing header
+    'timings_header': 'X-Request-Timings'
+}
+
+COMPRESSION = {
+    # Responses smaller than this many bytes are not compressed. Streamed responses are always compressed.
+    'min_size': int(os.environ.get('COMPRESSION_MIN_SIZE', 1024)),
+    'gzip_level': int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6)),
+    # br is only offered when the brotli package is installed
+    'brotli_quality': int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 4))
+}
+
+CHANGES = {
+    # Seconds between polls of the change log by each event stream
+    'poll_interval': float(os.environ.get('CHANGES_POLL_INTERVAL', 1)),
+    # Seconds without changes before an event stream sends a comment to keep the connection open
+    'keepalive': float(os.environ.get('CHANGES_KEEPALIVE', 15)),
+    # Seconds before an event stream ends. Clients reconnect with Last-Event-ID and resume where they left off.
+    'stream_timeout': float(os.environ.get('CHANGES_STREAM_TIMEOUT', 300))
 }
 
-# Tables
+JOBS = {
+    # Threads processing jobs in each process. With 0, jobs are processed in the request that submits them.
+    'workers': int(os.environ.get('JOB_WORKERS', 2)),
+    # Items processed per transaction
+    'batch_size': int(os.environ.get('JOB_BATCH_SIZE', 100)),
+    'max_attempts': int(os.environ.get('JOB_MAX_ATTEMPTS', 3)),
+    # Seconds a worker holds a running job without committing a batch before another worker can take it over
+    'lease_seconds': float(os.environ.get('JOB_LEASE_SECONDS', 60))
+}
+
+RATE_LIMIT = {
+    # memory (per process), redis (shared, requires the redis package) or none
+    'backend': os.environ.get('RATE_LIMIT_BACKEND', 'memory'),
+    'url': os.environ.get('RATE_LIMIT_URL', os.environ.get('CACHE_URL', 'redis://localhost:6379/0')),
+    # Requests per second per client, with bursts of up to burst requests
+    'rate': float(os.environ.get('RATE_LIMIT_RATE', 50)),
+    'burst': int(os.environ.get('RATE_LIMIT_BURST', 100)),
+    # Clients are identified by this header if set, such as an API key header set by a gateway, else by address
+    'client_header': os.environ.get('RATE_LIMIT_CLIENT_HEADER'),
+    'max_clients': int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', 100000))
+}
+
+# Requests to list and bulk endpoints in flight per process, further ones get a 503
+MAX_EXPENSIVE_REQUESTS = int(os.environ.get('MAX_EXPENSIVE_REQUESTS', 16))
+
+# Serve the Swagger UI at /apidocs/ and the spec at /apispec_1.json
+SWAGGER_ENABLED = os.environ.get('SWAGGER_ENABLED', 'true').lower() != 'false'
+
+# Threads serving requests in asgi.py
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 100))
+
+# Tables, suffixed with _TEST and the id of the test worker in tests so parallel test processes use their own tables
+TABLE_SUFFIX = '_TEST' + os.environ.get('TEST_WORKER', '') if os.environ.get('TEST') else ''
 PERSON_TABLE = 'person_table'
 PET_TABLE = 'pet_table'
+COUNTER_TABLE = 'counter_table'
+CHANGE_TABLE = 'change_table'
+JOB_TABLE = 'job_table'
+
+# Pagination
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+EXPORT_PAGE_SIZE = 1000
+
+# Bulk operations
+MAX_BULK_SIZE = 1000
+MAX_MULTI_GET_SIZE = 5000
+MAX_BULK_REMOVE_SIZE = 100000
+BULK_INSERT_BATCH_SIZE = 500
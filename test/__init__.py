@@ -1,3 +1,7 @@
 import os
 
 os.environ['TEST'] = 'True'
+# Each test process has its own in-memory database unless DATABASE_ENGINE is set, and its own tables in a database
+# shared by parallel processes, such as those of pytest-xdist.
+os.environ.setdefault('DATABASE_ENGINE', 'memory')
+os.environ.setdefault('TEST_WORKER', os.environ.get('PYTEST_XDIST_WORKER', ''))
@@ -0,0 +1,87 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from asgi import WsgiToAsgi
+
+
+class SlowApp:
+    """
+    WSGI app taking a while to respond, which records the most requests it had in flight.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.threads = set()
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.threads.add(threading.get_ident())
+
+        time.sleep(self.seconds)
+        with self._lock:
+            self.in_flight -= 1
+
+        body = environ['wsgi.input'].read() or environ['PATH_INFO'].encode()
+        start_response('201 Created', [('Content-Type', 'text/plain'), ('X-Client', environ['REMOTE_ADDR'])])
+        return [body]
+
+
+async def request(app, path, body=b''):
+    """
+    Send a request to an ASGI app and return the messages it sent.
+    """
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    disconnect = asyncio.Event()
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await disconnect.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': 'POST', 'path': path, 'query_string': b'', 'http_version': '1.1',
+             'headers': [(b'content-type', b'text/plain')], 'client': ('10.0.0.1', 1234)}
+    await app(scope, receive, send)
+    disconnect.set()
+    return sent
+
+
+class WsgiToAsgiTests(unittest.TestCase):
+    def test_requests_overlap(self):
+        wsgi_app = SlowApp(0.2)
+        app = WsgiToAsgi(wsgi_app, 10)
+
+        async def send_requests():
+            return await asyncio.gather(*[request(app, f'/{index}') for index in range(10)])
+
+        start = time.perf_counter()
+        responses = asyncio.run(send_requests())
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(wsgi_app.max_in_flight, 10)
+        self.assertEqual(len(wsgi_app.threads), 10)
+        self.assertLess(elapsed, 1)
+        self.assertEqual([sent[1]['body'] for sent in responses], [f'/{index}'.encode() for index in range(10)])
+
+    def test_response(self):
+        sent = asyncio.run(request(WsgiToAsgi(SlowApp(0), 1), '/persons', b'{"name": "A"}'))
+
+        self.assertEqual(sent[0], {'type': 'http.response.start', 'status': 201,
+                                   'headers': [(b'content-type', b'text/plain'), (b'x-client', b'10.0.0.1')]})
+        self.assertEqual(sent[1], {'type': 'http.response.body', 'body': b'{"name": "A"}', 'more_body': True})
+        self.assertEqual(sent[2], {'type': 'http.response.body'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,112 @@
+import os
+import tempfile
+from contextlib import ExitStack, contextmanager
+from unittest import mock
+
+import settings
+from cache import cache
+from limits import rate_limiter
+from metrics import clear as clear_metrics
+from models import db
 from utils import _create_tables, _drop_tables
 
+_tables_created = False
+_rollback = ExitStack()
+_file_database = ExitStack()
+
+
+def use_file_database():
+    """
+    Move db from the in-memory database to a temporary SQLite file until restore_database is called. Connections to
+    an in-memory database with a shared cache cannot write while another one is in a transaction, so tests of
+    concurrent requests run on the file. Other engines are kept.
+    """
+    global _tables_created
+    if settings.DATABASE['engine'] != 'memory':
+        return
+
+    # The in-memory database is discarded with its last connection and created again once db is moved back.
+    database, pragmas, connect_params = db.database, db._pragmas, dict(db.connect_params)
+    db.close_all()
+    directory = _file_database.enter_context(tempfile.TemporaryDirectory())
+    db.init(os.path.join(directory, 'test.db'), pragmas={'foreign_keys': 1, 'journal_mode': 'wal'}, uri=False)
+    _tables_created = False
+
+    @_file_database.callback
+    def restore():
+        global _tables_created
+        db.close_all()
+        db.init(database, pragmas=pragmas, **connect_params)
+        _tables_created = False
+
+
+def restore_database():
+    """
+    Move db back to the database it used before use_file_database.
+    """
+    _file_database.close()
+
+
+def setup_database(commit=False):
+    """
+    Create the tables if needed. Unless commit is true, the test then runs in a transaction that teardown_database
+    rolls back instead of recreating the tables. Tests whose requests run in other threads must commit.
+    """
+    global _tables_created
+    if not _tables_created:
+        # Tables left by an interrupted run are recreated empty.
+        _drop_tables()
+        _create_tables()
+        _tables_created = True
 
-def create_test_client(app):
+    if not commit:
+        _rollback.enter_context(db)
+        _rollback.callback(db.rollback)
+        # The app closes the connection of db after each request, which would end the transaction of the test.
+        _rollback.enter_context(mock.patch.object(db, 'close', lambda: False))
+
+
+def teardown_database():
+    """
+    Roll back the transaction of the test, or drop the tables it committed to.
+    """
+    global _tables_created
+    if db.in_transaction():
+        _rollback.close()
+    else:
+        _drop_tables()
+        _tables_created = False
+
+
+def create_test_client(app, commit=False):
     app.config['TESTING'] = True
     app.config['WTF_CSRF_ENABLED'] = False
     app.config['DEBUG'] = False
-    _create_tables()
+    setup_database(commit)
+    cache.clear()
+    clear_metrics()
+    rate_limiter.clear()
     return app.test_client()
 
 
 def destroy_test_client():
-    _drop_tables()
+    teardown_database()
+
+
+@contextmanager
+def count_queries():
+    """
+    Count the SQL queries executed inside the block. Inside the transaction of a test, the transactions of the app
+    are savepoints. Their releases stand in for commits and are not counted, like commits.
+    """
+    queries = mock.Mock(wraps=db.execute_sql)
+    execute_sql = db.execute_sql
+
+    def count(sql, *args, **kwargs):
+        if sql.startswith('RELEASE SAVEPOINT'):
+            return execute_sql(sql, *args, **kwargs)
+
+        return queries(sql, *args, **kwargs)
+
+    with mock.patch.object(db, 'execute_sql', count):
+        yield queries
@@ -0,0 +1,57 @@
+import unittest
+from unittest import mock
+
+import settings
+from cache import MemoryCache, NullCache, create_cache
+
+
+class MemoryCacheTests(unittest.TestCase):
+    def test_get_hit_and_miss(self):
+        cache = MemoryCache(max_size=2, ttl=60)
+        cache.set('a', {'id': 1})
+        self.assertEqual(cache.get('a'), {'id': 1})
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats(), {'backend': 'memory', 'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_set_evicts_least_recently_used(self):
+        cache = MemoryCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_get_expired(self):
+        cache = MemoryCache(max_size=2, ttl=60)
+        with mock.patch('cache.time.monotonic', return_value=0):
+            cache.set('a', 1)
+        with mock.patch('cache.time.monotonic', return_value=61):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_delete(self):
+        cache = MemoryCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.delete('a', 'b')
+        self.assertIsNone(cache.get('a'))
+
+
+class CreateCacheTests(unittest.TestCase):
+    def test_create_cache_memory(self):
+        cache = create_cache(dict(settings.CACHE, backend='memory', max_size=5, ttl=10))
+        self.assertIsInstance(cache, MemoryCache)
+        self.assertEqual(cache.max_size, 5)
+        self.assertEqual(cache.ttl, 10)
+
+    def test_create_cache_none(self):
+        self.assertIsInstance(create_cache(dict(settings.CACHE, backend='none')), NullCache)
+
+    def test_create_cache_backend_invalid(self):
+        with self.assertRaises(ValueError):
+            create_cache(dict(settings.CACHE, backend='memcached'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+import zlib
+from unittest import mock
+
+from compression import _compress_stream
+
+
+class CompressStreamTests(unittest.TestCase):
+    @mock.patch('settings.EXPORT_PAGE_SIZE', 2)
+    def test_compress_stream_flushes_pages(self):
+        chunks = [b'{"id": %d}\n' % index for index in range(5)]
+        produced = []
+
+        def produce():
+            for chunk in chunks:
+                produced.append(chunk)
+                yield chunk
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        received = b''
+        received_by_produced = {}
+        for data in _compress_stream(produce(), 'gzip'):
+            received += decompressor.decompress(data)
+            received_by_produced[len(produced)] = received
+
+        # Each page is received whole before the next chunk is produced.
+        self.assertEqual(received_by_produced[2], b''.join(chunks[:2]))
+        self.assertEqual(received_by_produced[4], b''.join(chunks[:4]))
+        self.assertEqual(received, b''.join(chunks))
+        self.assertTrue(decompressor.eof)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+from unittest import mock
+
+from limits import ConcurrencyLimiter, MemoryRateLimiter, NullRateLimiter
+
+
+class RateLimiterTests(unittest.TestCase):
+    @mock.patch('time.monotonic')
+    def test_memory_rate_limiter(self, monotonic):
+        monotonic.return_value = 100
+        limiter = MemoryRateLimiter(rate=2, burst=3, max_clients=10)
+        self.assertEqual([limiter.acquire('a') for _ in range(3)], [0, 0, 0])
+        self.assertEqual(limiter.acquire('a'), 0.5)
+        self.assertEqual(limiter.acquire('b'), 0)
+
+        monotonic.return_value = 100.5
+        self.assertEqual(limiter.acquire('a'), 0)
+        self.assertEqual(limiter.acquire('a'), 0.5)
+
+        monotonic.return_value = 1000
+        self.assertEqual([limiter.acquire('a') for _ in range(4)], [0, 0, 0, 0.5])
+
+    def test_memory_rate_limiter_max_clients(self):
+        limiter = MemoryRateLimiter(rate=0.001, burst=1, max_clients=2)
+        for key in ['a', 'b', 'c']:
+            self.assertEqual(limiter.acquire(key), 0)
+        self.assertGreater(limiter.acquire('c'), 0)
+        self.assertEqual(limiter.acquire('a'), 0)
+
+    def test_null_rate_limiter(self):
+        limiter = NullRateLimiter()
+        self.assertEqual([limiter.acquire('a') for _ in range(1000)], [0] * 1000)
+
+    def test_concurrency_limiter(self):
+        limiter = ConcurrencyLimiter(2)
+        self.assertEqual([limiter.acquire() for _ in range(3)], [True, True, False])
+        limiter.release()
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(limiter.in_flight, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
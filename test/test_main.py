@@ -1,19 +1,38 @@
+import gzip
 import json
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
+from peewee import OperationalError
 from playhouse.shortcuts import model_to_dict
 
-from main import app
-from models import Person, Pet
-from .test_base import create_test_client, destroy_test_client
+import operations
+from jobs import resume_jobs
+from limits import expensive_requests, rate_limiter
+from main import create_app
+from models import db, Job, Person, Pet, get_stats, rebuild_counters
+from .test_base import (create_test_client, destroy_test_client, count_queries, use_file_database,
+                        restore_database)
 
+app = create_app()
+
+
+class AppTests(unittest.TestCase):
+    """
+    Tests of the app with persons and pets, which run in a transaction rolled back after each test unless commit is
+    true.
+    """
+    commit = False
 
-class BasicTests(unittest.TestCase):
     def setUp(self):
-        self.app = create_test_client(app)
+        self.app = create_test_client(app, self.commit)
         self.assertEqual(app.debug, False)
 
-        self.app.NOT_FOUND_ID = 100
+        # Ids are not reused after a rollback on PostgreSQL.
+        self.app.NOT_FOUND_ID = 10 ** 9
         person1_unmarried = Person(first_name='A', last_name='First')
         person1_unmarried.save()
         person2 = Person(first_name='B', last_name='Second')
@@ -45,11 +64,81 @@ class BasicTests(unittest.TestCase):
     def tearDown(self):
         destroy_test_client()
 
+
+class BasicTests(AppTests):
     # person_list tests
     def test_person_list_happy_path(self):
         response = self.app.get('/persons')
         data = json.loads(response.data)
-        self.assertDictEqual(data, {'data': [model_to_dict(person) for person in self.app.persons_desc]})
+        self.assertDictEqual(data, {'data': [model_to_dict(person) for person in self.app.persons_desc],
+                                    'next_cursor': None})
+        self.assertEqual(response.status_code, 200)
+
+    def test_person_list_paginated_happy_path(self):
+        persons = self.app.persons_desc
+        response = self.app.get('/persons?limit=3')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'data': [model_to_dict(person) for person in persons[:3]],
+                                    'next_cursor': persons[2].id})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.app.get(f'/persons?limit=3&after_id={data["next_cursor"]}')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'data': [model_to_dict(person) for person in persons[3:]],
+                                    'next_cursor': None})
+        self.assertEqual(response.status_code, 200)
+
+    def test_person_list_limit_invalid(self):
+        response = self.app.get('/persons?limit=0')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'Message': 'limit must be between 1 and 1000'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_person_list_after_id_invalid(self):
+        response = self.app.get('/persons?after_id=abc')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'Message': 'after_id must be an integer'})
+        self.assertEqual(response.status_code, 400)
+
+    @mock.patch('settings.EXPORT_PAGE_SIZE', 3)
+    def test_person_list_ndjson_happy_path(self):
+        response = self.app.get('/persons', headers={'Accept': 'application/x-ndjson'})
+        data = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertListEqual(data, [model_to_dict(person) for person in self.app.persons_desc])
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+
+    def test_person_list_ndjson_after_id_happy_path(self):
+        persons = self.app.persons_desc
+        response = self.app.get(f'/persons?after_id={persons[1].id}', headers={'Accept': 'application/x-ndjson'})
+        data = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertListEqual(data, [model_to_dict(person) for person in persons[2:]])
+        self.assertEqual(response.status_code, 200)
+
+    def test_person_list_not_modified(self):
+        response = self.app.get('/persons')
+        etag = response.headers['ETag']
+        with count_queries() as queries:
+            response = self.app.get('/persons', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(queries.call_count, 1)
+        self.assertNotIn(Person._meta.table_name, queries.call_args.args[0])
+
+        response = self.app.get('/persons?limit=1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_person_list_modified(self):
+        person = self.app.persons[0]
+        etag = self.app.get('/persons').headers['ETag']
+        self.app.patch(f'/persons/{person.id}',
+                       data=json.dumps(dict(first_name='Ab')),
+                       content_type='application/json')
+        response = self.app.get('/persons', headers={'If-None-Match': etag})
+        data = json.loads(response.data)
+        self.assertEqual(data['data'][-1]['first_name'], 'Ab')
+        self.assertNotEqual(response.headers['ETag'], etag)
         self.assertEqual(response.status_code, 200)
 
     # person tests
@@ -60,12 +149,253 @@ class BasicTests(unittest.TestCase):
         self.assertDictEqual(data, model_to_dict(person))
         self.assertEqual(response.status_code, 200)
 
+    def test_person_cached_happy_path(self):
+        person = self.app.persons[3]
+        self.app.get(f'/persons/{person.id}')
+        with count_queries() as queries:
+            response = self.app.get(f'/persons/{person.id}')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, model_to_dict(person))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries.call_count, 0)
+
+        stats = json.loads(self.app.get('/cache/stats').data)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_person_cache_invalidated_on_update(self):
+        person = self.app.persons[2]
+        partner = self.app.persons[3]
+        self.app.get(f'/persons/{person.id}')
+        self.app.get(f'/persons/{partner.id}')
+        self.app.patch(f'/persons/{person.id}',
+                       data=json.dumps(dict(first_name='Yy')),
+                       content_type='application/json')
+        data = json.loads(self.app.get(f'/persons/{person.id}').data)
+        self.assertEqual(data['first_name'], 'Yy')
+        data = json.loads(self.app.get(f'/persons/{partner.id}').data)
+        self.assertEqual(data['partner']['first_name'], 'Yy')
+
+    def test_person_cache_invalidated_on_marriage(self):
+        partner = self.app.persons[1]
+        self.app.get(f'/persons/{partner.id}')
+        response = self.app.post('/persons',
+                                 data=json.dumps(dict(first_name='D', last_name='Second', partner_id=partner.id)),
+                                 content_type='application/json')
+        person_id = json.loads(response.data)['id']
+        data = json.loads(self.app.get(f'/persons/{partner.id}').data)
+        self.assertEqual(data['partner']['id'], person_id)
+
+    def test_person_cache_invalidated_on_remove(self):
+        person = self.app.persons[0]
+        self.app.get(f'/persons/{person.id}')
+        self.app.delete(f'/persons/{person.id}')
+        response = self.app.get(f'/persons/{person.id}')
+        self.assertEqual(response.status_code, 404)
+
+    def test_person_not_modified(self):
+        person = self.app.persons[0]
+        response = self.app.get(f'/persons/{person.id}')
+        etag = response.headers['ETag']
+        response = self.app.get(f'/persons/{person.id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        self.app.patch(f'/persons/{person.id}',
+                       data=json.dumps(dict(last_name='Firsts')),
+                       content_type='application/json')
+        response = self.app.get(f'/persons/{person.id}', headers={'If-None-Match': etag})
+        data = json.loads(response.data)
+        self.assertEqual(data['last_name'], 'Firsts')
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.status_code, 200)
+
     def test_person_not_found(self):
         response = self.app.get(f'/persons/{self.app.NOT_FOUND_ID}')
         data = json.loads(response.data)
         self.assertDictEqual(data, {'Message': 'Person not found'})
         self.assertEqual(response.status_code, 404)
 
+    # filter tests
+    def test_person_list_filter_first_name_happy_path(self):
+        for first_name in ['y', 'Y*', 'y*']:
+            response = self.app.get(f'/persons?first_name={first_name}')
+            data = json.loads(response.data)
+            self.assertDictEqual(data, {'data': [model_to_dict(self.app.persons[2])], 'next_cursor': None})
+            self.assertEqual(response.status_code, 200)
+
+    def test_person_list_filter_last_name_happy_path(self):
+        response = self.app.get('/persons?last_name=ZE*')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'data': [model_to_dict(person) for person in self.app.persons_desc[:2]],
+                                    'next_cursor': None})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.app.get('/persons?last_name=ze')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'data': [], 'next_cursor': None})
+        self.assertEqual(response.status_code, 200)
+
+    def test_person_list_filter_married_happy_path(self):
+        response = self.app.get('/persons?married=true')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'data': [model_to_dict(person) for person in self.app.persons_desc[:2]],
+                                    'next_cursor': None})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.app.get('/persons?married=false&last_name=f*', headers={'Accept': 'application/x-ndjson'})
+        data = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertListEqual(data, [model_to_dict(self.app.persons[0])])
+        self.assertEqual(response.status_code, 200)
+
+    def test_person_list_filter_invalid(self):
+        for query in ['married=yes', 'first_name=', 'last_name=*']:
+            response = self.app.get(f'/persons?{query}')
+            self.assertEqual(response.status_code, 400)
+
+    # format tests
+    def test_person_list_compact_happy_path(self):
+        response = self.app.get('/persons?format=compact&limit=1')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'data': [model_to_dict(self.app.persons[3], recurse=False)],
+                                    'next_cursor': self.app.persons[3].id})
+        self.assertEqual(response.status_code, 200)
+
+    def test_person_list_columnar_happy_path(self):
+        response = self.app.get('/persons?format=columnar')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'columns': ['id', 'first_name', 'last_name', 'partner'],
+                                    'rows': [[person.id, person.first_name, person.last_name, person.partner_id]
+                                             for person in self.app.persons_desc],
+                                    'next_cursor': None})
+        self.assertEqual(response.status_code, 200)
+
+    def test_person_list_format_invalid(self):
+        response = self.app.get('/persons?format=xml')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.app.get('/persons?format=columnar', headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(response.status_code, 400)
+
+    @mock.patch.dict('settings.COMPRESSION', min_size=0)
+    # compression tests
+    def test_person_list_gzip_happy_path(self):
+        response = self.app.get('/persons', headers={'Accept-Encoding': 'gzip'})
+        data = json.loads(gzip.decompress(response.data))
+        self.assertDictEqual(data, {'data': [model_to_dict(person) for person in self.app.persons_desc],
+                                    'next_cursor': None})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.vary)
+        self.assertEqual(response.status_code, 200)
+
+        etag, weak = response.get_etag()
+        self.assertTrue(weak)
+        response = self.app.get('/persons', headers={'Accept-Encoding': 'gzip', 'If-None-Match': f'W/"{etag}"'})
+        self.assertEqual(response.status_code, 304)
+
+    @mock.patch.dict('settings.COMPRESSION', min_size=0)
+    @mock.patch('settings.EXPORT_PAGE_SIZE', 1)
+    def test_person_list_ndjson_gzip_happy_path(self):
+        response = self.app.get('/persons?format=compact',
+                                headers={'Accept': 'application/x-ndjson', 'Accept-Encoding': 'gzip'})
+        data = [json.loads(line) for line in gzip.decompress(response.data).decode().splitlines()]
+        self.assertListEqual(data, [model_to_dict(person, recurse=False) for person in self.app.persons_desc])
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.status_code, 200)
+
+    def test_person_list_small_not_compressed(self):
+        response = self.app.get('/persons', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.status_code, 200)
+
+    # multi-get tests
+    def test_person_list_ids_happy_path(self):
+        persons = self.app.persons
+        ids = [persons[2].id, self.app.NOT_FOUND_ID, persons[0].id, persons[2].id]
+        with count_queries() as queries:
+            response = self.app.get('/persons?ids=' + ','.join(map(str, ids)))
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries.call_count, 1)
+        self.assertListEqual(data['data'], [
+            {'status': 200, 'body': model_to_dict(persons[2])},
+            {'status': 404, 'body': {'Message': 'Person not found'}},
+            {'status': 200, 'body': model_to_dict(persons[0])},
+            {'status': 200, 'body': model_to_dict(persons[2])}
+        ])
+
+    def test_person_list_ids_invalid(self):
+        response = self.app.get('/persons?ids=1,a')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'Message': 'ids must be a comma separated list of integers'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_person_list_ids_too_many(self):
+        response = self.app.get('/persons?ids=' + ','.join(['1'] * 5001))
+        self.assertEqual(response.status_code, 400)
+
+    def test_pets_ids_happy_path(self):
+        pets = self.app.pets
+        self.app.get(f'/persons/{pets[1].owner.id}')
+        ids = [pets[4].id, pets[1].id, self.app.NOT_FOUND_ID, pets[3].id]
+        with count_queries() as queries:
+            response = self.app.get('/pets?ids=' + ','.join(map(str, ids)))
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries.call_count, 1)
+        self.assertListEqual(data['data'], [
+            {'status': 200, 'body': model_to_dict(pets[4])},
+            {'status': 200, 'body': model_to_dict(pets[1])},
+            {'status': 404, 'body': {'Message': 'Pet not found'}},
+            {'status': 200, 'body': model_to_dict(pets[3])}
+        ])
+
+    def test_pets_ids_cached_owner(self):
+        pets = self.app.pets
+        self.app.get(f'/pets?ids={pets[2].id}')
+        self.app.get(f'/persons/{pets[2].owner.id}')
+        with count_queries() as queries:
+            response = self.app.get(f'/pets?ids={pets[2].id},{pets[3].id}')
+        data = json.loads(response.data)
+        self.assertEqual(queries.call_count, 1)
+        self.assertListEqual([result['body'] for result in data['data']],
+                             [model_to_dict(pets[2]), model_to_dict(pets[3])])
+
+    def test_pets_ids_missing(self):
+        response = self.app.get('/pets')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'Message': 'ids is required'})
+        self.assertEqual(response.status_code, 400)
+
+    # household tests
+    def test_household_happy_path(self):
+        person = self.app.persons[3]
+        partner = self.app.persons[2]
+        with count_queries() as queries:
+            response = self.app.get(f'/persons/{person.id}/household')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries.call_count, 1)
+        self.assertDictEqual(data, {
+            'person': model_to_dict(person),
+            'partner': model_to_dict(partner),
+            'pets': [{'id': pet.id, 'name': pet.name} for pet in self.app.pets_desc if pet.owner == person],
+            'partner_pets': [{'id': pet.id, 'name': pet.name} for pet in self.app.pets_desc if pet.owner == partner]
+        })
+
+    def test_household_unmarried(self):
+        person = self.app.persons[1]
+        response = self.app.get(f'/persons/{person.id}/household')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'person': model_to_dict(person), 'partner': None, 'pets': [], 'partner_pets': []})
+        self.assertEqual(response.status_code, 200)
+
+    def test_household_not_found(self):
+        response = self.app.get(f'/persons/{self.app.NOT_FOUND_ID}/household')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'Message': 'Person not found'})
+        self.assertEqual(response.status_code, 404)
+
     # create_person tests
     def test_create_person_happy_path(self):
         body = dict(first_name='C', last_name='Third')
@@ -118,6 +448,15 @@ class BasicTests(unittest.TestCase):
         self.assertDictEqual(data, {'Message': 'Partner not found'})
         self.assertEqual(response.status_code, 404)
 
+    def test_create_person_partner_id_invalid(self):
+        for partner_id in [True, False, '1']:
+            body = dict(first_name='E', last_name='Fourth', partner_id=partner_id)
+            response = self.app.post('/persons', data=json.dumps(body), content_type='application/json')
+            self.assertDictEqual(json.loads(response.data), {'Message': 'Partner id must be an integer'})
+            self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(Person.select().count(), len(self.app.persons))
+
     def test_create_person_partner_married_conflict(self):
         partner = next((person for person in self.app.persons if person.partner is not None), None)
         body = dict(first_name='D', last_name='Second', partner_id=partner.id)
@@ -128,6 +467,61 @@ class BasicTests(unittest.TestCase):
         self.assertDictEqual(data, {'Message': 'Partner already married'})
         self.assertEqual(response.status_code, 409)
 
+    # create_persons_bulk tests
+    def test_create_persons_bulk_happy_path(self):
+        partner = next((person for person in self.app.persons if person.partner is None), None)
+        body = [dict(first_name='C', last_name='Third'), dict(first_name='D', last_name='Second', partner_id=partner.id)]
+        with count_queries() as queries:
+            response = self.app.post('/persons:bulk',
+                                     data=json.dumps(body),
+                                     content_type='application/json')
+        data = json.loads(response.data)
+        self.assertEqual([result['status'] for result in data['data']], [201, 201])
+        self.assertEqual(data['data'][0]['body']['first_name'], body[0]['first_name'])
+        self.assertIsNone(data['data'][0]['body']['partner'])
+        self.assertEqual(data['data'][1]['body']['last_name'], body[1]['last_name'])
+        self.assertEqual(data['data'][1]['body']['partner']['id'], partner.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(queries.call_count, 7)
+
+        person_ids = [result['body']['id'] for result in data['data']]
+        self.assertEqual(Person.select().where(Person.id.in_(person_ids)).count(), 2)
+        self.assertEqual(Person.get_by_id(partner.id).partner_id, person_ids[1])
+
+    def test_create_persons_bulk_item_errors(self):
+        married = next((person for person in self.app.persons if person.partner is not None), None)
+        partner = next((person for person in self.app.persons if person.partner is None), None)
+        body = [dict(last_name='Third'),
+                dict(first_name='D'),
+                dict(first_name='E', last_name='Fourth', partner_id=self.app.NOT_FOUND_ID),
+                dict(first_name='F', last_name='Fifth', partner_id=married.id),
+                dict(first_name='G', last_name='Sixth', partner_id=partner.id),
+                dict(first_name='H', last_name='Sixth', partner_id=partner.id),
+                'I',
+                dict(first_name='J', last_name='Seventh', partner_id=True)]
+        response = self.app.post('/persons:bulk',
+                                 data=json.dumps(body),
+                                 content_type='application/json')
+        data = json.loads(response.data)
+        self.assertEqual(data['data'][0], {'status': 400, 'body': {'Message': 'First name is required'}})
+        self.assertEqual(data['data'][1], {'status': 400, 'body': {'Message': 'Last name is required'}})
+        self.assertEqual(data['data'][2], {'status': 404, 'body': {'Message': 'Partner not found'}})
+        self.assertEqual(data['data'][3], {'status': 409, 'body': {'Message': 'Partner already married'}})
+        self.assertEqual(data['data'][4]['status'], 201)
+        self.assertEqual(data['data'][5], {'status': 409, 'body': {'Message': 'Partner already married'}})
+        self.assertEqual(data['data'][6], {'status': 400, 'body': {'Message': 'Item must be an object'}})
+        self.assertEqual(data['data'][7], {'status': 400, 'body': {'Message': 'Partner id must be an integer'}})
+        self.assertEqual(response.status_code, 200)
+
+    def test_create_persons_bulk_not_list_invalid(self):
+        body = dict(first_name='C', last_name='Third')
+        response = self.app.post('/persons:bulk',
+                                 data=json.dumps(body),
+                                 content_type='application/json')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'Message': 'Body must be a list'})
+        self.assertEqual(response.status_code, 400)
+
     # update_person tests
     def test_update_person_happy_path(self):
         person = next((person for person in self.app.persons if person.partner is None), None)
@@ -214,6 +608,14 @@ class BasicTests(unittest.TestCase):
         self.assertDictEqual(data, {'Message': 'Partner already married'})
         self.assertEqual(response.status_code, 409)
 
+    def test_update_person_partner_id_invalid(self):
+        person = next((person for person in self.app.persons if person.partner is None), None)
+        response = self.app.patch(f'/persons/{person.id}', data=json.dumps(dict(partner_id=True)),
+                                  content_type='application/json')
+        self.assertDictEqual(json.loads(response.data), {'Message': 'Partner id must be an integer'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNone(Person.get_by_id(person.id).partner_id)
+
     def test_update_person_person_married_invalid(self):
         person = next((person for person in self.app.persons if person.partner is not None), None)
         partner = next((partner for partner in self.app.persons if partner.partner is None), None)
@@ -246,7 +648,8 @@ class BasicTests(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         pets_response = self.app.get('/persons/pets')
         pets_data = json.loads(pets_response.data)
-        self.assertDictEqual(pets_data, {'data': [model_to_dict(pet) for pet in null_owner_pets[::-1]]})
+        self.assertDictEqual(pets_data, {'data': [model_to_dict(pet) for pet in null_owner_pets[::-1]],
+                                         'next_cursor': None})
         self.assertEqual(response.status_code, 200)
 
     def test_remove_person_exists_with_pets_with_partner_happy_path(self):
@@ -264,7 +667,8 @@ class BasicTests(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         pets_response = self.app.get(f'/persons/{partner.id}/pets')
         pets_data = json.loads(pets_response.data)
-        self.assertDictEqual(pets_data, {'data': [model_to_dict(pet) for pet in partner_pets[::-1]]})
+        self.assertDictEqual(pets_data, {'data': [model_to_dict(pet) for pet in partner_pets[::-1]],
+                                         'next_cursor': None})
         self.assertEqual(response.status_code, 200)
 
     def test_remove_person_does_not_exists_happy_path(self):
@@ -282,6 +686,32 @@ class BasicTests(unittest.TestCase):
         self.assertDictEqual(data, model_to_dict(pet))
         self.assertEqual(response.status_code, 200)
 
+    def test_pet_cache_invalidated_on_remove(self):
+        person = self.app.persons[2]
+        partner = self.app.persons[3]
+        pet = next((pet for pet in self.app.pets if pet.owner == person), None)
+        self.app.get(f'/persons/{person.id}/pets/{pet.id}')
+        with count_queries() as queries:
+            self.app.get(f'/persons/{person.id}/pets/{pet.id}')
+        self.assertEqual(queries.call_count, 0)
+
+        self.app.delete(f'/persons/{person.id}')
+        response = self.app.get(f'/persons/{person.id}/pets/{pet.id}')
+        self.assertEqual(response.status_code, 404)
+        response = self.app.get(f'/persons/{partner.id}/pets/{pet.id}')
+        data = json.loads(response.data)
+        self.assertEqual(data['owner']['id'], partner.id)
+        self.assertIsNone(data['owner']['partner'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_pet_not_modified(self):
+        person = self.app.persons[0]
+        pet = self.app.pets[0]
+        etag = self.app.get(f'/persons/{person.id}/pets/{pet.id}').headers['ETag']
+        response = self.app.get(f'/persons/{person.id}/pets/{pet.id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
     def test_pet_not_found(self):
         person = next((person for person in self.app.persons_with_pets), None)
         response = self.app.get(f'/persons/{person.id}/pets/{self.app.NOT_FOUND_ID}')
@@ -307,16 +737,103 @@ class BasicTests(unittest.TestCase):
         null_owner_pets = [pet for pet in self.app.pets if pet.owner is None]
         response = self.app.get(f'/persons/pets')
         data = json.loads(response.data)
-        self.assertDictEqual(data, {'data': [model_to_dict(pet) for pet in null_owner_pets[::-1]]})
+        self.assertDictEqual(data, {'data': [model_to_dict(pet) for pet in null_owner_pets[::-1]],
+                                    'next_cursor': None})
+        self.assertEqual(response.status_code, 200)
+
+    @mock.patch('settings.EXPORT_PAGE_SIZE', 1)
+    def test_pet_list_null_owner_ndjson_happy_path(self):
+        null_owner_pets = [pet for pet in self.app.pets if pet.owner is None]
+        response = self.app.get('/persons/pets', headers={'Accept': 'application/x-ndjson'})
+        data = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertListEqual(data, [model_to_dict(pet) for pet in null_owner_pets[::-1]])
+        self.assertEqual(response.status_code, 200)
+
+    def test_pet_list_null_owner_filter_name_happy_path(self):
+        response = self.app.get('/persons/pets?name=pete')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'data': [model_to_dict(self.app.pets[4])], 'next_cursor': None})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.app.get('/persons/pets?name=peta')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'data': [], 'next_cursor': None})
         self.assertEqual(response.status_code, 200)
 
     # pet_list
+    def test_pet_list_filter_name_happy_path(self):
+        person = self.app.persons[3]
+        response = self.app.get(f'/persons/{person.id}/pets?name=PETD*')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'data': [model_to_dict(self.app.pets[3])], 'next_cursor': None})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.app.get(f'/persons/{person.id}/pets?name=*')
+        self.assertEqual(response.status_code, 400)
+
+    def test_pet_list_compact_happy_path(self):
+        person = self.app.persons[3]
+        pets = [pet for pet in self.app.pets if pet.owner == person]
+        response = self.app.get(f'/persons/{person.id}/pets?format=columnar')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'columns': ['id', 'name', 'owner'],
+                                    'rows': [[pet.id, pet.name, person.id] for pet in pets[::-1]],
+                                    'next_cursor': None})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.app.get('/persons/pets?format=compact', headers={'Accept': 'application/x-ndjson'})
+        data = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertListEqual(data, [{'id': self.app.pets[4].id, 'name': 'PetE', 'owner': None}])
+        self.assertEqual(response.status_code, 200)
+
+    def test_pet_list_paginated_happy_path(self):
+        person = self.app.persons[3]
+        pets = [pet for pet in self.app.pets if pet.owner == person][::-1]
+        response = self.app.get(f'/persons/{person.id}/pets?limit=1')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'data': [model_to_dict(pets[0])], 'next_cursor': pets[0].id})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.app.get(f'/persons/{person.id}/pets?limit=1&after_id={data["next_cursor"]}')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'data': [model_to_dict(pets[1])], 'next_cursor': None})
+        self.assertEqual(response.status_code, 200)
+
     def test_pet_list_happy_path(self):
         person = next((person for person in self.app.persons_with_pets), None)
         pets = [pet for pet in self.app.pets if pet.owner == person]
         response = self.app.get(f'/persons/{person.id}/pets')
         data = json.loads(response.data)
-        self.assertDictEqual(data, {'data': [model_to_dict(pet) for pet in pets[::-1]]})
+        self.assertDictEqual(data, {'data': [model_to_dict(pet) for pet in pets[::-1]],
+                                    'next_cursor': None})
+        self.assertEqual(response.status_code, 200)
+
+    def test_pet_list_ndjson_happy_path(self):
+        person = self.app.persons[3]
+        pets = [pet for pet in self.app.pets if pet.owner == person]
+        response = self.app.get(f'/persons/{person.id}/pets', headers={'Accept': 'application/x-ndjson'})
+        data = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertListEqual(data, [model_to_dict(pet) for pet in pets[::-1]])
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+
+    def test_pet_list_not_modified(self):
+        person = self.app.persons[0]
+        etag = self.app.get(f'/persons/{person.id}/pets').headers['ETag']
+        response = self.app.get(f'/persons/{person.id}/pets', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        self.app.post(f'/persons/{person.id}/pets',
+                      data=json.dumps(dict(name='PetF')),
+                      content_type='application/json')
+        response = self.app.get(f'/persons/{person.id}/pets', headers={'If-None-Match': etag})
+        self.assertEqual(len(json.loads(response.data)['data']), 2)
+        self.assertEqual(response.status_code, 200)
+
+        etag = response.headers['ETag']
+        response = self.app.get(f'/persons/{person.id}/pets',
+                                headers={'If-None-Match': etag, 'Accept': 'application/x-ndjson'})
         self.assertEqual(response.status_code, 200)
 
     def test_pet_list_owner_not_found(self):
@@ -357,6 +874,603 @@ class BasicTests(unittest.TestCase):
         self.assertDictEqual(data, {'Message': 'Name is required'})
         self.assertEqual(response.status_code, 400)
 
+    # query count tests
+    def _create_many(self, count):
+        Person.insert_many([dict(first_name=f'P{i}', last_name='Many') for i in range(count // 2)]).execute()
+        partners = Person.select().order_by(Person.id.desc()).limit(count // 2)
+        Person.insert_many([dict(first_name=f'P{i}', last_name='Many', partner=partner)
+                            for i, partner in enumerate(partners)]).execute()
+        owners = Person.select().order_by(Person.id.desc()).limit(count)
+        Pet.insert_many([dict(name=f'Pet{i}', owner=owner) for i, owner in enumerate(owners)]).execute()
+        Pet.insert_many([dict(name=f'Pet{i}', owner=self.app.persons[0]) for i in range(count)]).execute()
+        Pet.insert_many([dict(name=f'Pet{i}') for i in range(count)]).execute()
+
+    def test_person_list_query_count(self):
+        self._create_many(1000)
+        with count_queries() as queries:
+            response = self.app.get('/persons?limit=1000')
+        data = json.loads(response.data)
+        self.assertEqual(len(data['data']), 1000)
+        self.assertIsNotNone(data['data'][0]['partner'])
+        self.assertEqual(queries.call_count, 2)
+
+    def test_pet_list_query_count(self):
+        self._create_many(1000)
+        person = self.app.persons[0]
+        with count_queries() as queries:
+            response = self.app.get(f'/persons/{person.id}/pets?limit=1000')
+        data = json.loads(response.data)
+        self.assertEqual(len(data['data']), 1000)
+        self.assertEqual(data['data'][0]['owner']['id'], person.id)
+        self.assertEqual(queries.call_count, 3)
+
+    def test_pet_list_null_owner_query_count(self):
+        self._create_many(1000)
+        with count_queries() as queries:
+            response = self.app.get('/persons/pets?limit=1000')
+        data = json.loads(response.data)
+        self.assertEqual(len(data['data']), 1000)
+        self.assertEqual(queries.call_count, 2)
+
+    # metrics
+    def test_metrics_happy_path(self):
+        person = self.app.persons[0]
+        self.app.get(f'/persons/{person.id}')
+        self.app.get(f'/persons/{self.app.NOT_FOUND_ID}')
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        text = response.get_data(as_text=True)
+        self.assertIn('http_request_duration_seconds_count{endpoint="api.person",method="GET",status="200"} 1', text)
+        self.assertIn('http_request_duration_seconds_count{endpoint="api.person",method="GET",status="404"} 1', text)
+        self.assertIn('http_request_queries_bucket{endpoint="api.person",method="GET",status="200",le="1"} 1', text)
+        self.assertIn('http_request_phase_duration_seconds_count{endpoint="api.person",phase="encode"} 2', text)
+        self.assertIn('db_query_duration_seconds_count{operation="SELECT"}', text)
+
+    def test_request_timings_header(self):
+        response = self.app.post('/persons', data=json.dumps(dict(first_name='A', last_name='Timed')),
+                                 headers={'X-Request-Timings': '1'})
+        self.assertEqual(response.status_code, 201)
+        phases = [metric.split(';')[0] for metric in response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(phases, ['parse', 'db', 'serialize', 'encode', 'compress', 'total'])
+        self.assertGreater(int(response.headers['X-Query-Count']), 0)
+
+    def test_request_timings_header_not_requested(self):
+        response = self.app.get(f'/persons/{self.app.persons[0].id}')
+        self.assertNotIn('Server-Timing', response.headers)
+
+    # swagger
+    def test_swagger_spec(self):
+        response = self.app.get('/apispec_1.json')
+        self.assertEqual(response.status_code, 200)
+        paths = json.loads(response.data)['paths']
+        self.assertIn('get', paths['/persons/{person_id}/pets/{pet_id}'])
+        self.assertIn('delete', paths['/persons/{person_id}'])
+
+    def test_swagger_created_on_first_request(self):
+        app = create_app()
+        client = app.test_client()
+        self.assertEqual(client.get(f'/persons/{self.app.persons[0].id}').status_code, 200)
+        self.assertIsNone(app.wsgi_app.docs_app)
+
+        self.assertEqual(client.get('/apidocs/').status_code, 200)
+        self.assertIsNotNone(app.wsgi_app.docs_app)
+        self.assertEqual(client.get('/apispec_1.json').status_code, 200)
+
+    def test_swagger_disabled(self):
+        client = create_app({'SWAGGER_ENABLED': False}).test_client()
+        self.assertEqual(client.get('/apidocs/').status_code, 404)
+        self.assertEqual(client.get('/apispec_1.json').status_code, 404)
+        self.assertEqual(client.get(f'/persons/{self.app.persons[0].id}').status_code, 200)
+
+    # create_pets_bulk
+    def test_create_pets_bulk_happy_path(self):
+        person = self.app.persons[0]
+        body = [dict(name='PetF'), dict(), dict(name='PetG')]
+        response = self.app.post(f'/persons/{person.id}/pets:bulk',
+                                 data=json.dumps(body),
+                                 content_type='application/json')
+        data = json.loads(response.data)
+        self.assertEqual([result['status'] for result in data['data']], [201, 400, 201])
+        self.assertEqual(data['data'][0]['body']['name'], 'PetF')
+        self.assertEqual(data['data'][0]['body']['owner']['id'], person.id)
+        self.assertEqual(data['data'][1]['body'], {'Message': 'Name is required'})
+        self.assertEqual(data['data'][2]['body']['name'], 'PetG')
+        self.assertEqual(response.status_code, 200)
+
+        pets = Pet.select().where(Pet.id.in_([data['data'][0]['body']['id'], data['data'][2]['body']['id']]))
+        self.assertEqual(sorted(pet.name for pet in pets), ['PetF', 'PetG'])
+
+    def test_create_pets_bulk_owner_not_found(self):
+        response = self.app.post(f'/persons/{self.app.NOT_FOUND_ID}/pets:bulk',
+                                 data=json.dumps([dict(name='PetF')]),
+                                 content_type='application/json')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'Message': 'Owner not found'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_create_pets_bulk_owner_removed(self):
+        person = self.app.persons[1]
+        lock_persons = operations._lock_persons
+
+        def remove_then_lock(*person_ids):
+            Person.delete().where(Person.id == person.id).execute()
+            return lock_persons(*person_ids)
+
+        with mock.patch('operations._lock_persons', remove_then_lock):
+            response = self.app.post(f'/persons/{person.id}/pets:bulk',
+                                     data=json.dumps([dict(name='PetF')]),
+                                     content_type='application/json')
+        self.assertDictEqual(json.loads(response.data), {'Message': 'Owner not found'})
+        self.assertEqual(response.status_code, 404)
+
+    # changes
+    def test_change_list_happy_path(self):
+        partner = self.app.persons[1]
+        response = self.app.post('/persons',
+                                 data=json.dumps(dict(first_name='D', last_name='Second', partner_id=partner.id)),
+                                 content_type='application/json')
+        person_id = json.loads(response.data)['id']
+        response = self.app.post(f'/persons/{person_id}/pets', data=json.dumps(dict(name='PetF')),
+                                 content_type='application/json')
+        pet_id = json.loads(response.data)['id']
+
+        response = self.app.get('/changes')
+        data = json.loads(response.data)
+        seq = data['data'][0]['seq']
+        self.assertDictEqual(data, {'data': [
+            {'seq': seq, 'entity': 'person', 'id': person_id, 'action': 'created',
+             'data': {'id': person_id, 'first_name': 'D', 'last_name': 'Second', 'partner': partner.id}},
+            {'seq': seq + 1, 'entity': 'person', 'id': partner.id, 'action': 'updated',
+             'data': {'id': partner.id, 'first_name': 'B', 'last_name': 'Second', 'partner': person_id}},
+            {'seq': seq + 2, 'entity': 'pet', 'id': pet_id, 'action': 'created',
+             'data': {'id': pet_id, 'name': 'PetF', 'owner': person_id}}
+        ], 'next_cursor': seq + 2})
+        self.assertEqual(response.status_code, 200)
+
+        self.app.delete(f'/persons/{person_id}')
+        response = self.app.get(f'/changes?since={seq + 2}&limit=2')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'data': [
+            {'seq': seq + 3, 'entity': 'person', 'id': person_id, 'action': 'removed', 'data': None},
+            {'seq': seq + 4, 'entity': 'pet', 'id': pet_id, 'action': 'updated',
+             'data': {'id': pet_id, 'name': 'PetF', 'owner': partner.id}}
+        ], 'next_cursor': seq + 4})
+
+        response = self.app.get(f'/changes?since={seq + 4}')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'data': [
+            {'seq': seq + 5, 'entity': 'person', 'id': partner.id, 'action': 'updated',
+             'data': {'id': partner.id, 'first_name': 'B', 'last_name': 'Second', 'partner': None}}
+        ], 'next_cursor': seq + 5})
+
+        response = self.app.get(f'/changes?since={seq + 5}')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'data': [], 'next_cursor': seq + 5})
+
+    def test_change_list_update_person(self):
+        person = self.app.persons[2]
+        self.app.patch(f'/persons/{person.id}', data=json.dumps(dict(first_name='Yy')),
+                       content_type='application/json')
+        data = json.loads(self.app.get('/changes').data)
+        self.assertEqual([(change['entity'], change['id'], change['action'], change['data'])
+                          for change in data['data']],
+                         [('person', person.id, 'updated',
+                           {'id': person.id, 'first_name': 'Yy', 'last_name': 'Zeta', 'partner': person.partner_id})])
+
+    def test_change_list_invalid(self):
+        response = self.app.get('/changes?since=x')
+        self.assertEqual(response.status_code, 400)
+
+    @mock.patch.dict('settings.CHANGES', stream_timeout=0)
+    def test_change_list_event_stream_happy_path(self):
+        person = self.app.persons[0]
+        for name in ['PetF', 'PetG']:
+            self.app.post(f'/persons/{person.id}/pets', data=json.dumps(dict(name=name)),
+                          content_type='application/json')
+        changes = json.loads(self.app.get('/changes').data)['data']
+
+        response = self.app.get('/changes', headers={'Accept': 'text/event-stream'})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.decode(),
+                         ''.join(f'id: {change["seq"]}\ndata: {json.dumps(change, sort_keys=True)}\n\n'
+                                 for change in changes))
+
+        response = self.app.get('/changes', headers={'Accept': 'text/event-stream',
+                                                     'Last-Event-ID': str(changes[0]['seq'])})
+        self.assertEqual(response.data.decode(),
+                         f'id: {changes[1]["seq"]}\ndata: {json.dumps(changes[1], sort_keys=True)}\n\n')
+
+    @mock.patch.dict('settings.CHANGES', stream_timeout=0.05, keepalive=0, poll_interval=0.01)
+    def test_change_list_event_stream_keepalive(self):
+        response = self.app.get('/changes', headers={'Accept': 'text/event-stream'})
+        self.assertTrue(response.data.decode().startswith(':\n\n'))
+        self.assertEqual(response.status_code, 200)
+
+    # jobs
+    @mock.patch.dict('settings.JOBS', workers=0, batch_size=2)
+    def test_remove_persons_job_happy_path(self):
+        person1, _, person3, person4 = self.app.persons
+        person_ids = [person1.id, person3.id, self.app.NOT_FOUND_ID]
+        response = self.app.post('/persons:remove', data=json.dumps(person_ids), content_type='application/json')
+        data = json.loads(response.data)
+        self.assertDictEqual(data, {'id': data['id'], 'kind': 'remove_persons', 'status': 'done', 'total': 3,
+                                    'processed': 3, 'rows_removed': 2, 'attempts': 1, 'error': None})
+        self.assertEqual(response.headers['Location'], f'/jobs/{data["id"]}')
+        self.assertEqual(response.status_code, 202)
+
+        response = self.app.get(f'/jobs/{data["id"]}')
+        self.assertDictEqual(json.loads(response.data), data)
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(Person.select().where(Person.id.in_(person_ids)).count(), 0)
+        self.assertIsNone(Person.get_by_id(person4.id).partner_id)
+        self.assertEqual(sorted(pet.name for pet in Pet.select().where(Pet.owner == person4.id)),
+                         ['PetB', 'PetC', 'PetD'])
+        self.assertEqual(Pet.select().where(Pet.owner.is_null()).count(), 2)
+
+    @mock.patch.dict('settings.JOBS', workers=0)
+    def test_remove_persons_job_partners_in_batch(self):
+        person3, person4 = self.app.persons[2:]
+        response = self.app.post('/persons:remove', data=json.dumps([person4.id, person3.id, person4.id]),
+                                 content_type='application/json')
+        data = json.loads(response.data)
+        self.assertEqual((data['status'], data['rows_removed']), ('done', 2))
+        self.assertEqual(Pet.select().where(Pet.owner.is_null()).count(), 4)
+
+    @mock.patch.dict('settings.JOBS', workers=0, batch_size=1)
+    def test_remove_persons_job_retried(self):
+        remove_persons = operations.remove_persons
+        calls = []
+
+        def fail_second_batch_once(person_ids, progress):
+            calls.append(person_ids)
+            if len(calls) == 2:
+                raise OperationalError('Deadlock detected')
+            return remove_persons(person_ids, progress)
+
+        person_ids = [person.id for person in self.app.persons[:2]]
+        with mock.patch('operations.remove_persons', side_effect=fail_second_batch_once):
+            response = self.app.post('/persons:remove', data=json.dumps(person_ids), content_type='application/json')
+        data = json.loads(response.data)
+        self.assertEqual((data['status'], data['processed'], data['rows_removed'], data['attempts'], data['error']),
+                         ('done', 2, 2, 2, 'Deadlock detected'))
+        self.assertEqual(calls, [person_ids[:1], person_ids[1:], person_ids[1:]])
+
+    @mock.patch.dict('settings.JOBS', workers=0, max_attempts=2)
+    def test_remove_persons_job_failed(self):
+        with mock.patch('operations.remove_persons', side_effect=OperationalError('Database is locked')):
+            response = self.app.post('/persons:remove', data=json.dumps([self.app.persons[0].id]),
+                                     content_type='application/json')
+        data = json.loads(response.data)
+        self.assertEqual((data['status'], data['processed'], data['attempts'], data['error']),
+                         ('failed', 0, 2, 'Database is locked'))
+        self.assertEqual(Person.select().count(), 4)
+
+    def test_remove_persons_job_invalid(self):
+        for body in [{}, ['1'], [1.5], [True]]:
+            response = self.app.post('/persons:remove', data=json.dumps(body), content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_job_not_found(self):
+        response = self.app.get(f'/jobs/{self.app.NOT_FOUND_ID}')
+        self.assertDictEqual(json.loads(response.data), {'Message': 'Job not found'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_resume_jobs(self):
+        person_ids = [person.id for person in self.app.persons[:2]]
+        job = Job.create(kind='remove_persons', items=json.dumps(person_ids), total=2, processed=1, status='running',
+                         lease_expires=time.time() - 1)
+        resume_jobs()
+        job = Job.get_by_id(job.id)
+        self.assertEqual((job.status, job.processed, job.rows_removed), ('done', 2, 1))
+        self.assertEqual([person.id for person in Person.select().where(Person.id.in_(person_ids))], person_ids[:1])
+
+    # rate limits
+    def test_rate_limit_exceeded(self):
+        person = self.app.persons[0]
+        with mock.patch.object(rate_limiter, 'burst', 2), mock.patch.object(rate_limiter, 'rate', 0.5):
+            self.assertEqual(self.app.get(f'/persons/{person.id}').status_code, 200)
+            self.assertEqual(self.app.get(f'/persons/{person.id}').status_code, 200)
+            response = self.app.get(f'/persons/{person.id}')
+            self.assertDictEqual(json.loads(response.data), {'Message': 'Too many requests'})
+            self.assertEqual(response.headers['Retry-After'], '2')
+            self.assertEqual(response.status_code, 429)
+
+            response = self.app.get(f'/persons/{person.id}', environ_base={'REMOTE_ADDR': '10.0.0.2'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.app.get('/metrics').status_code, 200)
+
+    @mock.patch.dict('settings.RATE_LIMIT', client_header='X-Api-Key')
+    def test_rate_limit_client_header(self):
+        with mock.patch.object(rate_limiter, 'burst', 1), mock.patch.object(rate_limiter, 'rate', 0.5):
+            self.assertEqual(self.app.get('/persons', headers={'X-Api-Key': 'a'}).status_code, 200)
+            self.assertEqual(self.app.get('/persons', headers={'X-Api-Key': 'a'}).status_code, 429)
+            self.assertEqual(self.app.get('/persons', headers={'X-Api-Key': 'b'}).status_code, 200)
+
+    def test_expensive_requests_limit_exceeded(self):
+        with mock.patch.object(expensive_requests, 'limit', 0):
+            response = self.app.get('/persons')
+            self.assertDictEqual(json.loads(response.data), {'Message': 'Too many requests in progress'})
+            self.assertEqual(response.headers['Retry-After'], '1')
+            self.assertEqual(response.status_code, 503)
+
+            response = self.app.get(f'/persons/{self.app.persons[0].id}')
+            self.assertEqual(response.status_code, 200)
+
+    def test_expensive_requests_released(self):
+        with mock.patch.object(expensive_requests, 'limit', 1):
+            self.assertEqual(self.app.get('/persons').status_code, 200)
+            self.assertEqual(self.app.get('/persons?limit=0').status_code, 400)
+
+            response = self.app.get('/persons', headers={'Accept': 'application/x-ndjson'}, buffered=False)
+            self.assertEqual(expensive_requests.in_flight, 1)
+            self.assertEqual(self.app.get('/persons/pets').status_code, 503)
+            response.close()
+            self.assertEqual(expensive_requests.in_flight, 0)
+            self.assertEqual(self.app.get('/persons/pets').status_code, 200)
+
+    # stats
+    def test_stats_happy_path(self):
+        rebuild_counters()
+        with count_queries() as queries:
+            response = self.app.get('/stats')
+        self.assertDictEqual(json.loads(response.data), {
+            'persons': 4, 'married_pairs': 1, 'pets': 5, 'unowned_pets': 1,
+            'pets_per_person': [{'pets': 0, 'persons': 1}, {'pets': 1, 'persons': 2}, {'pets': 2, 'persons': 1}]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries.call_count, 1)
+
+    @mock.patch.dict('settings.JOBS', workers=0)
+    def test_stats_follow_mutations(self):
+        rebuild_counters()
+        person1, person2, person3, person4 = self.app.persons
+        body = dict(first_name='C', last_name='New', partner_id=person2.id)
+        response = self.app.post('/persons', data=json.dumps(body), content_type='application/json')
+        person5_id = json.loads(response.data)['id']
+        response = self.app.post('/persons:bulk', data=json.dumps([dict(first_name='D', last_name='Bulk'),
+                                                                    dict(first_name='E', last_name='Bulk')]),
+                                 content_type='application/json')
+        person6_id, person7_id = [result['body']['id'] for result in json.loads(response.data)['data']]
+        self.app.put(f'/persons/{person6_id}', data=json.dumps(dict(partner_id=person7_id)),
+                     content_type='application/json')
+        self.app.post(f'/persons/{person5_id}/pets', data=json.dumps(dict(name='PetF')),
+                      content_type='application/json')
+        self.app.post(f'/persons/{person2.id}/pets:bulk', data=json.dumps([dict(name='PetG'), dict(name='PetH')]),
+                      content_type='application/json')
+        self.app.delete(f'/persons/{person4.id}')
+        self.app.delete(f'/persons/{person1.id}')
+        self.app.post('/persons:remove', data=json.dumps([person2.id, person5_id, person3.id]),
+                      content_type='application/json')
+
+        stats = get_stats()
+        self.assertEqual(stats['persons'], 2)
+        rebuild_counters()
+        self.assertDictEqual(get_stats(), stats)
+
+    def test_count_only(self):
+        rebuild_counters()
+        person4 = self.app.persons[3]
+        for url, count in [('/persons', 4), ('/persons?married=true', 2), ('/persons?married=false', 2),
+                           ('/persons?last_name=zeta', 2), ('/persons/pets', 1), ('/persons/pets?name=PetA', 0),
+                           (f'/persons/{person4.id}/pets', 2), (f'/persons/{person4.id}/pets?name=PetC', 1)]:
+            response = self.app.get(url + ('&' if '?' in url else '?') + 'count_only=true')
+            self.assertDictEqual(json.loads(response.data), {'count': count}, url)
+            self.assertEqual(response.status_code, 200)
+
+        with count_queries() as queries:
+            self.assertEqual(self.app.get('/persons?count_only=true&married=true').status_code, 200)
+        self.assertEqual(queries.call_count, 1)
+
+    def test_count_only_invalid(self):
+        response = self.app.get('/persons?count_only=yes')
+        self.assertDictEqual(json.loads(response.data), {'Message': 'count_only must be true or false'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.app.get(f'/persons/{self.app.NOT_FOUND_ID}/pets?count_only=true').status_code, 404)
+
+    # batch
+    def test_batch_happy_path(self):
+        person2 = self.app.persons[1]
+        self.assertIsNone(json.loads(self.app.get(f'/persons/{person2.id}').data)['partner'])
+        items = [dict(op='create_person', ref='new', body=dict(first_name='C', last_name='New')),
+                 dict(op='update_person', person_id='$new', body=dict(partner_id=person2.id)),
+                 dict(op='create_pet', person_id='$new', ref='pet', body=dict(name='PetF')),
+                 dict(op='create_pet', person_id='$new', body=dict(name='PetG')),
+                 dict(op='remove_person', person_id=self.app.persons[0].id)]
+        response = self.app.post('/batch', data=json.dumps(items), content_type='application/json')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in data['data']], [201, 200, 201, 201, 200])
+
+        person_id = data['data'][0]['body']['id']
+        self.assertEqual(data['data'][1]['body']['partner']['id'], person2.id)
+        self.assertEqual(data['data'][2]['body']['owner']['id'], person_id)
+        self.assertDictEqual(data['data'][4]['body'], {'Message': 'Number of rows removed: 1'})
+        self.assertEqual(Person.get_by_id(person2.id).partner_id, person_id)
+        self.assertEqual(sorted(pet.name for pet in Pet.select().where(Pet.owner == person_id)), ['PetF', 'PetG'])
+        self.assertEqual(json.loads(self.app.get(f'/persons/{person2.id}').data)['partner']['id'], person_id)
+
+    def test_batch_results_as_each_item_left_them(self):
+        items = [dict(op='create_person', ref='a', body=dict(first_name='A', last_name='New')),
+                 dict(op='create_person', ref='b', body=dict(first_name='B', last_name='New', partner_id='$a')),
+                 dict(op='create_pet', person_id='$a', body=dict(name='PetF')),
+                 dict(op='update_person', person_id='$a', body=dict(first_name='A2')),
+                 dict(op='remove_person', person_id='$a')]
+        response = self.app.post('/batch', data=json.dumps(items), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        a, b, pet, updated_a, removed = [result['body'] for result in json.loads(response.data)['data']]
+
+        self.assertEqual((a['first_name'], a['partner']), ('A', None))
+        self.assertEqual((b['first_name'], b['partner']['id'], b['partner']['first_name']), ('B', a['id'], 'A'))
+        self.assertEqual((pet['owner']['id'], pet['owner']['first_name']), (a['id'], 'A'))
+        self.assertEqual((updated_a['first_name'], updated_a['partner']['id']), ('A2', b['id']))
+        self.assertDictEqual(removed, {'Message': 'Number of rows removed: 1'})
+        self.assertEqual(Pet.get(Pet.name == 'PetF').owner_id, b['id'])
+
+    def test_batch_rolled_back(self):
+        items = [dict(op='create_person', ref='new', body=dict(first_name='C', last_name='New')),
+                 dict(op='create_pet', person_id='$new', body=dict(name='PetF')),
+                 dict(op='create_pet', person_id=self.app.NOT_FOUND_ID, body=dict(name='PetG'))]
+        response = self.app.post('/batch', data=json.dumps(items), content_type='application/json')
+        self.assertDictEqual(json.loads(response.data), {'Message': 'Owner not found', 'index': 2})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(Person.select().count(), len(self.app.persons))
+        self.assertEqual(Pet.select().count(), len(self.app.pets))
+
+    def test_batch_invalid(self):
+        for items, message, index in [
+                ({}, 'Body must be a list', None),
+                ([dict(op='create_pet', person_id='$missing', body=dict(name='PetF'))],
+                 'Unknown reference $missing', 0),
+                ([dict(op='create_person', body=dict(first_name='C', last_name='New')), dict(op='drop')],
+                 'Unsupported op: drop', 1),
+                ([dict(op='update_person', person_id=self.app.persons[0].id, body=dict(partner_id='x'))],
+                 'Partner id must be an integer', 0),
+                ([dict(op='update_person', person_id=self.app.persons[0].id, body=dict(partner_id=True))],
+                 'Partner id must be an integer', 0),
+                ([dict(op='remove_person', person_id=True)], 'Person id must be an integer', 0)]:
+            response = self.app.post('/batch', data=json.dumps(items), content_type='application/json')
+            expected = {'Message': message} if index is None else {'Message': message, 'index': index}
+            self.assertDictEqual(json.loads(response.data), expected)
+            self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(Person.select().count(), len(self.app.persons))
+
+    def test_batch_shares_lookups(self):
+        person1, person2 = self.app.persons[0], self.app.persons[1]
+        with count_queries() as queries:
+            response = self.app.post('/persons', data=json.dumps(dict(first_name='C', last_name='New')),
+                                     content_type='application/json')
+            person_id = json.loads(response.data)['id']
+            self.app.patch(f'/persons/{person_id}', data=json.dumps(dict(partner_id=person2.id)),
+                         content_type='application/json')
+            for name in ['PetF', 'PetG', 'PetH']:
+                self.app.post(f'/persons/{person_id}/pets', data=json.dumps(dict(name=name)),
+                              content_type='application/json')
+
+        items = [dict(op='create_person', ref='new', body=dict(first_name='D', last_name='New')),
+                 dict(op='update_person', person_id='$new', body=dict(partner_id=person1.id)),
+                 *[dict(op='create_pet', person_id='$new', body=dict(name=name)) for name in ['PetF', 'PetG', 'PetH']]]
+        with count_queries() as batch_queries:
+            response = self.app.post('/batch', data=json.dumps(items), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        # The batch locks the new person and counts its pets once instead of once per item.
+        self.assertLess(batch_queries.call_count, queries.call_count)
+
+
+class CommitTests(AppTests):
+    """
+    Tests that release the connection or send requests from other threads, which need the changes to be committed.
+    """
+    commit = True
+
+    @classmethod
+    def setUpClass(cls):
+        use_file_database()
+
+    @classmethod
+    def tearDownClass(cls):
+        restore_database()
+
+    # connection tests
+    def test_person_list_releases_connection(self):
+        response = self.app.get('/persons')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(db.is_closed())
+
+    def test_person_list_ndjson_releases_connection(self):
+        response = self.app.get('/persons', headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(len(response.data.decode().splitlines()), len(self.app.persons))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(db.is_closed())
+
+    # jobs
+    @mock.patch.dict('settings.JOBS', workers=2)
+    def test_remove_persons_job_workers(self):
+        response = self.app.post('/persons:remove', data=json.dumps([person.id for person in self.app.persons]),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        location = response.headers['Location']
+        for _ in range(500):
+            data = json.loads(self.app.get(location).data)
+            if data['status'] == 'done':
+                break
+            time.sleep(0.01)
+
+        self.assertEqual((data['status'], data['rows_removed']), ('done', 4))
+        self.assertEqual(Person.select().count(), 0)
+
+    # concurrency tests
+    def _send_concurrently(self, method, requests):
+        barrier = threading.Barrier(len(requests))
+
+        def send(request):
+            url, body = request
+            client = app.test_client()
+            barrier.wait()
+            return client.open(url, method=method, data=json.dumps(body), content_type='application/json')
+
+        with ThreadPoolExecutor(len(requests)) as executor:
+            return list(executor.map(send, requests))
+
+    def test_create_person_concurrent_marriage(self):
+        partner = self.app.persons[1]
+        responses = self._send_concurrently('POST', [('/persons', dict(first_name=f'C{i}', last_name='Third',
+                                                                             partner_id=partner.id))
+                                                     for i in range(16)])
+        status_codes = [response.status_code for response in responses]
+        self.assertEqual(status_codes.count(201), 1)
+        self.assertEqual(status_codes.count(409), 15)
+
+        person_id = next(json.loads(response.data)['id'] for response in responses if response.status_code == 201)
+        self.assertEqual(Person.get_by_id(partner.id).partner_id, person_id)
+        self.assertEqual([person.id for person in Person.select().where(Person.partner == partner.id)], [person_id])
+
+    def test_update_person_concurrent_marriage(self):
+        partner = self.app.persons[1]
+        persons = [Person.create(first_name=f'C{i}', last_name='Third') for i in range(16)]
+        responses = self._send_concurrently('PATCH', [(f'/persons/{person.id}', dict(partner_id=partner.id))
+                                                      for person in persons])
+        status_codes = [response.status_code for response in responses]
+        self.assertEqual(status_codes.count(200), 1)
+        self.assertEqual(status_codes.count(409), 15)
+
+        person_id = next(json.loads(response.data)['id'] for response in responses if response.status_code == 200)
+        self.assertEqual(Person.get_by_id(partner.id).partner_id, person_id)
+        self.assertEqual([person.id for person in Person.select().where(Person.partner == partner.id)], [person_id])
+
+    def test_update_person_concurrent_cross_marriage(self):
+        person = self.app.persons[0]
+        partner = self.app.persons[1]
+        responses = self._send_concurrently('PATCH', [(f'/persons/{person.id}', dict(partner_id=partner.id)),
+                                                      (f'/persons/{partner.id}', dict(partner_id=person.id))] * 4)
+        status_codes = [response.status_code for response in responses]
+        self.assertNotIn(500, status_codes)
+        self.assertEqual(Person.get_by_id(person.id).partner_id, partner.id)
+        self.assertEqual(Person.get_by_id(partner.id).partner_id, person.id)
+
+    def test_remove_person_concurrent(self):
+        person = self.app.persons[3]
+        partner = self.app.persons[2]
+        responses = self._send_concurrently('DELETE', [(f'/persons/{person.id}', None)] * 8)
+        messages = sorted(json.loads(response.data)['Message'] for response in responses)
+        self.assertEqual(messages, ['Number of rows removed: 0'] * 7 + ['Number of rows removed: 1'])
+        self.assertIsNone(Person.get_by_id(partner.id).partner_id)
+        self.assertEqual(Pet.select().where(Pet.owner == partner.id).count(), 3)
+
+    def test_create_pet_concurrent_stats(self):
+        rebuild_counters()
+        person = self.app.persons[1]
+        responses = self._send_concurrently('POST', [(f'/persons/{person.id}/pets', dict(name='Pet'))] * 8)
+        self.assertEqual([response.status_code for response in responses], [201] * 8)
+
+        stats = get_stats()
+        self.assertIn({'pets': 8, 'persons': 1}, stats['pets_per_person'])
+        rebuild_counters()
+        self.assertDictEqual(get_stats(), stats)
+
 
 if __name__ == '__main__':
     unittest.main()
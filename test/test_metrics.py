@@ -0,0 +1,39 @@
+import unittest
+from unittest import mock
+
+from metrics import Histogram, instrument_database
+
+
+class HistogramTests(unittest.TestCase):
+    def test_render(self):
+        histogram = Histogram('duration_seconds', 'Duration.', ('endpoint',), (0.1, 1))
+        histogram.observe(0.05, 'a')
+        histogram.observe(0.5, 'a')
+        self.assertEqual(histogram.render(), '\n'.join([
+            '# HELP duration_seconds Duration.',
+            '# TYPE duration_seconds histogram',
+            'duration_seconds_bucket{endpoint="a",le="0.1"} 1',
+            'duration_seconds_bucket{endpoint="a",le="1"} 2',
+            'duration_seconds_bucket{endpoint="a",le="+Inf"} 2',
+            'duration_seconds_sum{endpoint="a"} 0.55',
+            'duration_seconds_count{endpoint="a"} 2',
+        ]) + '\n')
+
+    def test_render_empty(self):
+        histogram = Histogram('duration_seconds', 'Duration.', ('endpoint',), (0.1, 1))
+        self.assertEqual(histogram.render(), '# HELP duration_seconds Duration.\n# TYPE duration_seconds histogram\n')
+
+
+class InstrumentDatabaseTests(unittest.TestCase):
+    def test_slow_query_logged(self):
+        database = mock.Mock(spec=['execute_sql'])
+        instrument_database(database)
+        with mock.patch.dict('settings.METRICS', slow_query_ms=0), \
+                self.assertLogs('metrics', level='WARNING') as logs:
+            database.execute_sql('SELECT 1')
+        self.assertIn('Slow query', logs.output[0])
+        self.assertIn('SELECT 1', logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+
+from playhouse.pool import PooledPostgresqlDatabase, PooledSqliteDatabase
+
+import settings
+from models import create_database
+
+
+class CreateDatabaseTests(unittest.TestCase):
+    def test_create_database_postgres(self):
+        config = dict(settings.DATABASE, engine='postgres', max_connections=5, stale_timeout=60)
+        database = create_database(config)
+        self.assertIsInstance(database, PooledPostgresqlDatabase)
+        self.assertEqual(database._max_connections, 5)
+        self.assertEqual(database._stale_timeout, 60)
+
+    def test_create_database_sqlite(self):
+        config = dict(settings.DATABASE, engine='sqlite', db_name=':memory:')
+        database = create_database(config)
+        self.assertIsInstance(database, PooledSqliteDatabase)
+        self.assertEqual(database._max_connections, settings.DATABASE['max_connections'])
+
+    def test_create_database_memory(self):
+        config = dict(settings.DATABASE, engine='memory', db_name='test_create_database_memory')
+        database = create_database(config)
+        self.assertIsInstance(database, PooledSqliteDatabase)
+        self.assertIsNone(database._stale_timeout)
+
+        with database.connection_context():
+            database.execute_sql('CREATE TABLE kept (id INTEGER)')
+        with database.connection_context():
+            self.assertEqual(database.get_tables(), ['kept'])
+
+    def test_create_database_engine_invalid(self):
+        config = dict(settings.DATABASE, engine='mysql')
+        with self.assertRaises(ValueError):
+            create_database(config)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import json
+import unittest
+from unittest import mock
+
+from peewee import OperationalError
+
+import settings
+from main import create_app
+from models import create_replica, replicas, using, Person
+from utils import MODELS
+from .test_base import create_test_client, destroy_test_client
+
+app = create_app()
+
+
+def _get_replica_address(config):
+    """
+    Return the address of a second local database acting as the replica of the test database.
+    """
+    if config['engine'] in ('sqlite', 'memory'):
+        return config['db_name'] + '_replica'
+
+    return f"{config['host']}:{config['port']}/{config['db_name']}_replica"
+
+
+class ReplicaTests(unittest.TestCase):
+    def setUp(self):
+        self.replica = create_replica(settings.DATABASE, _get_replica_address(settings.DATABASE))
+        try:
+            with self.replica, using(self.replica):
+                self.replica.create_tables(MODELS)
+        except OperationalError as e:
+            self.skipTest(f'Replica database not available: {e}')
+
+        self.app = create_test_client(app)
+        replicas.append(self.replica)
+        self.person = Person.create(first_name='A', last_name='Primary')
+
+    def tearDown(self):
+        replicas.remove(self.replica)
+        destroy_test_client()
+        with self.replica, using(self.replica):
+            self.replica.drop_tables(MODELS)
+        self.replica.close_all()
+
+    def _get_last_names(self):
+        return [person['last_name'] for person in json.loads(self.app.get('/persons').data)['data']]
+
+    def test_reads_from_replica(self):
+        self.assertEqual(self._get_last_names(), [])
+        with using(self.replica):
+            Person.create(first_name='B', last_name='Replica')
+
+        self.assertEqual(self._get_last_names(), ['Replica'])
+        self.assertTrue(self.replica.is_closed())
+
+    def test_reads_from_primary_after_write(self):
+        response = self.app.post('/persons', data=json.dumps(dict(first_name='C', last_name='Written')),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertIn('last_write=', response.headers['Set-Cookie'])
+        self.assertEqual(self._get_last_names(), ['Written', 'Primary'])
+
+        with mock.patch('settings.REPLICA_STICKY_SECONDS', 0):
+            self.assertEqual(self._get_last_names(), [])
+
+    def test_cache_loads_from_primary(self):
+        response = self.app.get(f'/persons/{self.person.id}')
+        self.assertEqual(json.loads(response.data)['last_name'], 'Primary')
+        self.assertEqual(response.status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
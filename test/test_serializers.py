@@ -0,0 +1,65 @@
+import unittest
+
+from flask import json
+from playhouse.shortcuts import model_to_dict
+
+from main import create_app
+from models import Person, Pet
+from serializers import (PERSON_COLUMNS, PET_COLUMNS, encode_person_row, encode_person_row_columnar,
+                         encode_person_row_compact, encode_pet_row, encode_pet_row_columnar, encode_pet_row_compact,
+                         person_row_to_dict, select_person_rows, select_pet_rows)
+from .test_base import create_test_client, destroy_test_client
+
+app = create_app()
+
+
+class SerializerTests(unittest.TestCase):
+    def setUp(self):
+        create_test_client(app)
+        single = Person.create(first_name='Zoë', last_name='"Quoted"\n')
+        person = Person.create(first_name='A', last_name='Married')
+        partner = Person.create(first_name='日本', last_name='Married', partner=person)
+        person.partner = partner
+        person.save()
+        Pet.create(name='Pet\\1', owner=single)
+        Pet.create(name='Pet2', owner=partner)
+        Pet.create(name='Pet3')
+
+    def tearDown(self):
+        destroy_test_client()
+
+    def test_encode_person_row_matches_model_to_dict(self):
+        persons = Person.select().order_by(Person.id)
+        rows = select_person_rows().order_by(Person.id)
+        with app.app_context():
+            for person, row in zip(persons, rows):
+                self.assertEqual(encode_person_row(row), json.dumps(model_to_dict(person)))
+                self.assertEqual(person_row_to_dict(row), model_to_dict(person))
+
+    def test_encode_pet_row_matches_model_to_dict(self):
+        pets = Pet.select().order_by(Pet.id)
+        rows = select_pet_rows().order_by(Pet.id)
+        with app.app_context():
+            for pet, row in zip(pets, rows):
+                self.assertEqual(encode_pet_row(row), json.dumps(model_to_dict(pet)))
+
+    def test_encode_compact_rows(self):
+        persons = Person.select().order_by(Person.id)
+        rows = select_person_rows().order_by(Person.id)
+        with app.app_context():
+            for person, row in zip(persons, rows):
+                compact = model_to_dict(person, recurse=False)
+                self.assertEqual(encode_person_row_compact(row), json.dumps(compact))
+                self.assertEqual(json.loads(encode_person_row_columnar(row)),
+                                 [compact[column] for column in PERSON_COLUMNS])
+
+            pets = Pet.select().order_by(Pet.id)
+            rows = select_pet_rows().order_by(Pet.id)
+            for pet, row in zip(pets, rows):
+                compact = model_to_dict(pet, recurse=False)
+                self.assertEqual(encode_pet_row_compact(row), json.dumps(compact))
+                self.assertEqual(json.loads(encode_pet_row_columnar(row)), [compact[column] for column in PET_COLUMNS])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import unittest
+
+from peewee import Case, IntegrityError, PostgresqlDatabase
+
+from models import db, Person, Pet, insert_many, ConflictException
+from serializers import select_person_rows, select_pet_rows
+from utils import _migrate, filter_persons, filter_pets
+from .test_base import setup_database, teardown_database
+
+
+class MigrateTests(unittest.TestCase):
+    def setUp(self):
+        setup_database()
+
+    def tearDown(self):
+        teardown_database()
+
+    def _get_indexes(self, model):
+        return {index.name: (index.unique, set(index.columns) - {None})
+                for index in db.get_indexes(model._meta.table_name) if not index.name.endswith('_pkey')}
+
+    def test_migrate_legacy_indexes(self):
+        person_table = Person._meta.table_name
+        pet_table = Pet._meta.table_name
+        for model in [Person, Pet]:
+            for index in model._meta.fields_to_index():
+                db.execute_sql(f'DROP INDEX "{index._name}"')
+        db.execute_sql(f'CREATE INDEX "{person_table}_legacy_partner" ON "{person_table}" ("partner")')
+        db.execute_sql(f'CREATE UNIQUE INDEX "{pet_table}_null_owner_id" ON "{pet_table}" ("id")')
+
+        _migrate()
+
+        self.assertDictEqual(self._get_indexes(Person), {f'{person_table}_partner': (True, {'partner'}),
+                                                         f'{person_table}_married_id': (False, {'id'}),
+                                                         f'{person_table}_lower_first_name_id': (False, {'id'}),
+                                                         f'{person_table}_lower_last_name_id': (False, {'id'})})
+        self.assertDictEqual(self._get_indexes(Pet), {f'{pet_table}_owner_id': (False, {'owner', 'id'}),
+                                                      f'{pet_table}_null_owner_id': (False, {'id'}),
+                                                      f'{pet_table}_lower_name_id': (False, {'id'})})
+
+    def test_migrate_changed_predicate(self):
+        pet_table = Pet._meta.table_name
+        db.execute_sql(f'DROP INDEX "{pet_table}_null_owner_id"')
+        db.execute_sql(f'CREATE INDEX "{pet_table}_null_owner_id" ON "{pet_table}" ("id") WHERE owner IS NOT NULL')
+
+        _migrate()
+
+        index, = [index for index in db.get_indexes(pet_table) if index.name == f'{pet_table}_null_owner_id']
+        self.assertNotIn('NOT NULL', index.sql)
+        self.assertIn('IS NULL', index.sql)
+
+    def test_migrate_shared_partners(self):
+        person_table = Person._meta.table_name
+        db.execute_sql(f'DROP INDEX "{person_table}_partner"')
+        partner = Person.create(first_name='A', last_name='First')
+        first = Person.create(first_name='B', last_name='First', partner=partner)
+        second = Person.create(first_name='C', last_name='First', partner=partner)
+
+        with self.assertRaises(ConflictException) as context:
+            _migrate()
+
+        self.assertIn(f'ids {first.id}, {second.id} have partner {partner.id}', str(context.exception))
+        self.assertNotIn(f'{person_table}_partner', [index.name for index in db.get_indexes(person_table)])
+
+    def test_migrate_keeps_rows(self):
+        person = Person.create(first_name='A', last_name='First')
+        Pet.create(name='PetA', owner=person)
+
+        _migrate()
+        _migrate()
+
+        self.assertEqual(Person.select().count(), 1)
+        self.assertEqual(Pet.select().where(Pet.owner == person).count(), 1)
+
+    def test_partner_unique(self):
+        partner = Person.create(first_name='A', last_name='First')
+        Person.create(first_name='B', last_name='First', partner=partner)
+        with self.assertRaises(IntegrityError):
+            with db.atomic():
+                Person.create(first_name='C', last_name='First', partner=partner)
+
+
+class FilterPlanTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        setup_database()
+        persons = [dict(first_name=f'First{i}', last_name=f'Last{i % 500}') for i in range(20000)]
+        person_ids = insert_many(Person, persons)
+        offset = Person.id - person_ids[0]
+        (Person
+         .update(partner=Case(None, [(offset == offset / 2 * 2, Person.id + 1)], Person.id - 1))
+         .where(Person.id.between(person_ids[0], person_ids[999]))
+         .execute())
+        insert_many(Pet, [dict(name=f'Pet{i}', owner=person_ids[i % 20000] if i % 3 else None) for i in range(40000)])
+        db.execute_sql('ANALYZE')
+
+    @classmethod
+    def tearDownClass(cls):
+        teardown_database()
+
+    def _get_scans(self, query):
+        """
+        Return the lines of the query plan that read a whole table. Sorting the rows read, which prefix matches need
+        since the index returns them in name order, is not a scan.
+        """
+        sql, params = query.order_by(query.model.id.desc()).limit(101).sql()
+        if isinstance(db, PostgresqlDatabase):
+            plan = [row[0] for row in db.execute_sql('EXPLAIN ' + sql, params)]
+            return [line for line in plan if 'Seq Scan' in line]
+
+        plan = [row[3] for row in db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params)]
+        return [line for line in plan if line.startswith('SCAN') and 'INDEX' not in line]
+
+    def test_filter_persons_by_name(self):
+        for args in [{'first_name': 'first1234'}, {'first_name': 'FIRST1234*'}, {'last_name': 'Last123'},
+                     {'last_name': 'last123*'}]:
+            self.assertEqual(self._get_scans(filter_persons(select_person_rows(), args)), [], args)
+
+    def test_filter_persons_by_married(self):
+        for args in [{'married': 'true'}, {'married': 'false'}]:
+            self.assertEqual(self._get_scans(filter_persons(select_person_rows(), args)), [], args)
+
+    def test_filter_pets_by_name(self):
+        for query in [select_pet_rows(), select_pet_rows().where(Pet.owner.is_null()),
+                      select_pet_rows().where(Pet.owner == 1)]:
+            for args in [{'name': 'pet1234'}, {'name': 'PET1234*'}]:
+                self.assertEqual(self._get_scans(filter_pets(query, args)), [], args)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,25 @@
-from flask import Response, json
+import hashlib
+import math
+import re
+import sys
+import time
+from collections import defaultdict
 
-from models import db, Person, Pet, InvalidRequestException, NotFoundException, ConflictException
+from flask import Response, json, stream_with_context
+from peewee import IntegrityError, fn
+from playhouse import shortcuts
+from playhouse.migrate import SchemaMigrator, migrate
 
-MODELS = [Person, Pet]
+import settings
+from metrics import timed, timing
+from models import (db, Change, Counter, Job, Person, Pet, get_stats, match_married, match_text, rebuild_counters,
+                    InvalidRequestException,
+                    NotFoundException, ConflictException, TooManyRequestsException, ServiceUnavailableException)
+
+MODELS = [Person, Pet, Counter, Change, Job]
+FORMATS = ('full', 'compact', 'columnar')
+
+model_to_dict = timed('serialize')(shortcuts.model_to_dict)
 
 
 def _create_tables():
@@ -15,11 +32,400 @@ def _drop_tables():
         db.drop_tables(MODELS)
 
 
-def generate_response(json_object, code):
+def _is_primary_key_index(model, index):
+    return index.unique and index.columns == [model._meta.primary_key.column_name]
+
+
+def _get_index_definition(sql):
+    """
+    Return the definition of an index from its CREATE INDEX statement, leaving out what databases spell differently:
+    case, quotes, schema, access method, casts, parentheses and whitespace. PostgreSQL also spells IN as = ANY.
+    """
+    sql = sql.lower().replace('if not exists ', '').replace('using btree ', '').replace('public.', '')
+    sql = re.sub(r'= any \(array\[(.*?)\]\)', r'in (\1)', sql)
+    sql = re.sub(r'::\w+', '', sql)
+    return re.sub(r'[\s"()]', '', sql)
+
+
+def _check_unique(model, index):
+    """
+    Raise ConflictException naming the rows that share a value of the column of a unique index, which it could not be
+    created with.
+    """
+    field = index._expressions[0]
+    primary_key = model._meta.primary_key
+    values = (model
+              .select(field)
+              .where(field.is_null(False))
+              .group_by(field)
+              .having(fn.COUNT(primary_key) > 1)
+              .limit(10))
+    ids = defaultdict(list)
+    rows = model.select(primary_key, field).where(field.in_(values)).order_by(field, primary_key)
+    for row_id, value in rows.tuples():
+        ids[value].append(row_id)
+
+    if ids:
+        shared = '; '.join(f'ids {", ".join(map(str, row_ids))} have {field.column_name} {value}'
+                           for value, row_ids in ids.items())
+        raise ConflictException(f'Cannot create unique index {index._name} on {model._meta.table_name}, change these '
+                                f'rows so that no two share a {field.column_name} and migrate again: {shared}')
+
+
+def _migrate():
+    """
+    Create missing tables and bring the indexes of existing tables in line with the models without recreating them.
+    The stats counters are then recomputed from the tables.
+    """
+    migrator = SchemaMigrator.from_database(db)
+    with db:
+        # Indexes of existing tables are only created once checked below.
+        db.create_tables([model for model in MODELS if not model.table_exists()])
+        for model in MODELS:
+            table_name = model._meta.table_name
+            indexes = {index._name: index for index in model._meta.fields_to_index()}
+            missing = set(indexes)
+            for index in db.get_indexes(table_name):
+                declared = indexes.get(index.name)
+                if declared is None:
+                    if not _is_primary_key_index(model, index):
+                        migrate(migrator.drop_index(table_name, index.name))
+                elif (_get_index_definition(index.sql) !=
+                      _get_index_definition(db.get_sql_context().sql(declared).query()[0])):
+                    migrate(migrator.drop_index(table_name, index.name))
+                else:
+                    missing.discard(index.name)
+
+            for name in sorted(missing):
+                if indexes[name]._unique:
+                    _check_unique(model, indexes[name])
+
+            model._schema.create_indexes(safe=True)
+
+        rebuild_counters()
+
+
+def get_int_arg(args, name, default=None):
+    """
+    Return an integer query argument or default if missing.
+    """
+    value = args.get(name)
+    if value is None:
+        return default
+
+    try:
+        return int(value)
+    except ValueError:
+        raise InvalidRequestException(f'{name} must be an integer')
+
+
+def get_ids_arg(args):
+    """
+    Return the ids of the comma separated ids query argument or None if missing.
+    """
+    value = args.get('ids')
+    if value is None:
+        return None
+
+    try:
+        ids = [int(item) for item in value.split(',')]
+    except ValueError:
+        raise InvalidRequestException('ids must be a comma separated list of integers')
+
+    if len(ids) > settings.MAX_MULTI_GET_SIZE:
+        raise InvalidRequestException(f'ids must have at most {settings.MAX_MULTI_GET_SIZE} items')
+
+    return ids
+
+
+def get_limit_arg(args):
+    """
+    Return the limit query argument of a page.
+    """
+    limit = get_int_arg(args, 'limit', settings.PAGE_SIZE)
+    if limit < 1 or limit > settings.MAX_PAGE_SIZE:
+        raise InvalidRequestException(f'limit must be between 1 and {settings.MAX_PAGE_SIZE}')
+
+    return limit
+
+
+def get_page_args(args):
+    """
+    Return the limit and after_id cursor from the query arguments.
+    """
+    return get_limit_arg(args), get_int_arg(args, 'after_id')
+
+
+def _get_id(result):
+    """
+    Return the id of a model or of a row whose first column is the id.
+    """
+    return result[0] if isinstance(result, tuple) else result.id
+
+
+def get_format_arg(request):
+    """
+    Return the format query argument of a list, full by default. columnar is only available for JSON pages.
+    """
+    value = request.args.get('format', 'full')
+    if value not in FORMATS:
+        raise InvalidRequestException(f'format must be one of {", ".join(FORMATS)}')
+
+    if value == 'columnar' and wants_ndjson(request):
+        raise InvalidRequestException('format columnar is not available for application/x-ndjson')
+
+    return value
+
+
+def get_bool_arg(args, name):
+    """
+    Return a query argument of true or false as a bool, or None if missing.
+    """
+    value = args.get(name)
+    if value is not None and value not in ('true', 'false'):
+        raise InvalidRequestException(f'{name} must be true or false')
+
+    return None if value is None else value == 'true'
+
+
+def _get_text_arg(args, name):
+    """
+    Return a text query argument to match or None if missing.
+    """
+    value = args.get(name)
+    if value is not None and value in ('', '*'):
+        raise InvalidRequestException(f'{name} must not be empty')
+
+    return value
+
+
+def filter_persons(query, args):
+    """
+    Return the query of persons filtered by the first_name, last_name and married query arguments.
+    Names match case-insensitively, by prefix if they end with *.
+    """
+    for name, field in [('first_name', Person.first_name), ('last_name', Person.last_name)]:
+        value = _get_text_arg(args, name)
+        if value is not None:
+            query = query.where(match_text(field, value))
+
+    married = get_bool_arg(args, 'married')
+    if married is not None:
+        query = query.where(match_married(married))
+
+    return query
+
+
+def count_persons(args):
+    """
+    Return the number of persons matching the filter query arguments, read from the stats counters unless names are
+    filtered.
+    """
+    query = filter_persons(Person.select(), args)
+    if args.get('first_name') is not None or args.get('last_name') is not None:
+        return query.count()
+
+    stats = get_stats()
+    married = get_bool_arg(args, 'married')
+    if married is None:
+        return stats['persons']
+
+    married_persons = stats['married_pairs'] * 2
+    return married_persons if married else stats['persons'] - married_persons
+
+
+def filter_pets(query, args):
+    """
+    Return the query of pets filtered by the name query argument, which matches case-insensitively, by prefix if it
+    ends with *.
+    """
+    value = _get_text_arg(args, 'name')
+    if value is not None:
+        query = query.where(match_text(Pet.name, value))
+
+    return query
+
+
+def paginate(query, model, limit, after_id=None):
+    """
+    Return a page of results ordered by descending id and the cursor of the next page.
+    """
+    if after_id is not None:
+        query = query.where(model.id < after_id)
+
+    results = list(query.order_by(model.id.desc()).limit(limit + 1))
+    next_cursor = _get_id(results[limit - 1]) if len(results) > limit else None
+    return results[:limit], next_cursor
+
+
+def iterate_pages(query, model, after_id=None):
+    """
+    Yield every result ordered by descending id, fetching one page at a time.
+    """
+    while True:
+        page = query.order_by(model.id.desc()).limit(settings.EXPORT_PAGE_SIZE)
+        if after_id is not None:
+            page = page.where(model.id < after_id)
+
+        count = 0
+        for result in page.iterator():
+            count += 1
+            after_id = _get_id(result)
+            yield result
+
+        if count < settings.EXPORT_PAGE_SIZE:
+            return
+
+
+def wants_ndjson(request):
+    """
+    Return whether the request accepts newline delimited JSON over JSON.
+    """
+    return request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+
+def wants_event_stream(request):
+    """
+    Return whether the request accepts server-sent events over JSON.
+    """
+    return request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream'
+
+
+def poll_changes(select_rows, since):
+    """
+    Yield the rows of select_rows(since) and then of each later poll after the last row, or None after keepalive
+    seconds without rows, until the stream times out. Each poll holds a connection only while it queries.
+    """
+    now = time.monotonic()
+    deadline = now + settings.CHANGES['stream_timeout']
+    idle_since = now
+    while True:
+        with db.connection_context():
+            rows = list(select_rows(since).limit(settings.EXPORT_PAGE_SIZE))
+
+        for row in rows:
+            since = _get_id(row)
+            yield row
+
+        now = time.monotonic()
+        if rows:
+            idle_since = now
+            if len(rows) == settings.EXPORT_PAGE_SIZE:
+                continue
+
+        if now >= deadline:
+            return
+
+        if now - idle_since >= settings.CHANGES['keepalive']:
+            idle_since = now
+            yield None
+
+        time.sleep(settings.CHANGES['poll_interval'])
+
+
+def generate_etag(*parts):
+    """
+    Return a strong ETag for the parts that version a response.
+    """
+    return hashlib.sha1(':'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def get_list_etag(request, version):
+    """
+    Return a strong ETag for a list from its version and the representation requested.
+    """
+    return generate_etag(version, request.full_path, request.accept_mimetypes)
+
+
+def generate_response(json_object, code, etag=None):
     """
     Return a Flask response with a JSON body.
     """
-    return Response(json.dumps(json_object), status=code, mimetype='application/json')
+    with timing('encode'):
+        body = json.dumps(json_object)
+
+    return generate_json_response(body, code, etag)
+
+
+def generate_page_response(encoded_results, next_cursor, code, etag=None, columns=None):
+    """
+    Return a Flask response with a JSON body for a page of results that are already encoded as JSON, as rows of
+    columns if given.
+    """
+    with timing('encode'):
+        if columns is None:
+            body = '{"data": [%s], "next_cursor": %s}' % (', '.join(encoded_results), json.dumps(next_cursor))
+        else:
+            body = '{"columns": %s, "rows": [%s], "next_cursor": %s}' % (
+                json.dumps(columns), ', '.join(encoded_results), json.dumps(next_cursor))
+
+    return generate_json_response(body, code, etag)
+
+
+def generate_json_response(body, code, etag=None):
+    """
+    Return a Flask response with a body that is already encoded as JSON.
+    """
+    response = Response(body, status=code, mimetype='application/json')
+    if etag is not None:
+        response.set_etag(etag)
+        response.vary.add('Accept')
+
+    return response
+
+
+def generate_conditional_response(request, json_object, code):
+    """
+    Return a Flask response with a JSON body and an ETag of the body, or a bodyless 304 if the client has it.
+    """
+    response = generate_response(json_object, code)
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    return response.make_conditional(request)
+
+
+def generate_not_modified_response(etag):
+    """
+    Return a bodyless Flask response for a client that has the ETag.
+    """
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.vary.add('Accept')
+    return response
+
+
+def generate_stream_response(results, encode, code, etag=None):
+    """
+    Return a Flask streaming response with a JSON object per line for each result, encoded by encode.
+    """
+    def generate():
+        for result in results:
+            yield encode(result) + '\n'
+
+    response = Response(stream_with_context(generate()), status=code, mimetype='application/x-ndjson')
+    if etag is not None:
+        response.set_etag(etag)
+        response.vary.add('Accept')
+
+    return response
+
+
+def generate_event_stream_response(results, encode):
+    """
+    Return a Flask streaming response with a server-sent event for each result, with its id and its JSON encoded by
+    encode, and a comment for each None to keep the connection open.
+    """
+    def generate():
+        for result in results:
+            if result is None:
+                yield ':\n\n'
+            else:
+                yield f'id: {_get_id(result)}\ndata: {encode(result)}\n\n'
+
+    response = Response(generate(), status=200, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stops nginx from buffering the events
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 def generate_message_response(message, code):
@@ -30,23 +436,86 @@ def generate_message_response(message, code):
     return generate_response(json_object, code)
 
 
-def generate_error_response(exception):
+def get_error_code(exception):
     """
-    Return a Flask response with a JSON error body and code based on exception.
+    Return the HTTP status code based on exception.
     """
     exception_type = type(exception)
-    exception_message = str(exception)
     if exception_type is InvalidRequestException:
-        response = generate_message_response(exception_message, 400)
+        code = 400
     elif exception_type is NotFoundException:
-        response = generate_message_response(exception_message, 404)
-    elif exception_type is ConflictException:
-        response = generate_message_response(exception_message, 409)
+        code = 404
+    elif exception_type is ConflictException or isinstance(exception, IntegrityError):
+        code = 409
+    elif exception_type is TooManyRequestsException:
+        code = 429
+    elif exception_type is ServiceUnavailableException:
+        code = 503
     else:
-        response = generate_message_response(exception_message, 500)
+        code = 500
+
+    return code
+
+
+def generate_error_response(exception):
+    """
+    Return a Flask response with a JSON error body and code based on exception, with the index of the batch item that
+    failed and when to retry if it says.
+    """
+    json_object = {'Message': str(exception)}
+    index = getattr(exception, 'index', None)
+    if index is not None:
+        json_object['index'] = index
+
+    response = generate_response(json_object, get_error_code(exception))
+    retry_after = getattr(exception, 'retry_after', None)
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
 
     return response
 
 
+def generate_item_result(body, code):
+    """
+    Return the result of one item of a bulk request.
+    """
+    return {'status': code, 'body': body}
+
+
+def generate_item_error_result(exception):
+    """
+    Return the result of one failed item of a bulk request with a code based on exception.
+    """
+    return generate_item_result({'Message': str(exception)}, get_error_code(exception))
+
+
+def generate_multi_get_response(ids, results, not_found_message):
+    """
+    Return a Flask response with the result of each requested id in request order, from results by id or not found.
+    """
+    return generate_response({'data': [generate_item_result(results[item_id], 200) if item_id in results
+                                       else generate_item_error_result(NotFoundException(not_found_message))
+                                       for item_id in ids]}, 200)
+
+
+def get_bulk_items(data):
+    """
+    Return the items of a bulk request body.
+    """
+    if not isinstance(data, list):
+        raise InvalidRequestException('Body must be a list')
+
+    if len(data) > settings.MAX_BULK_SIZE:
+        raise InvalidRequestException(f'Body must have at most {settings.MAX_BULK_SIZE} items')
+
+    return data
+
+
+COMMANDS = {
+    '_create_tables': _create_tables,
+    '_migrate': _migrate,
+    'rebuild_counters': rebuild_counters
+}
+
 if __name__ == '__main__':
-    _create_tables()
+    COMMANDS[sys.argv[1] if len(sys.argv) > 1 else '_create_tables']()
@@ -0,0 +1,8 @@
+"""
+WSGI entry point for production servers, for example:
+
+    gunicorn wsgi:app --workers 4 --threads 8
+"""
+from main import create_app
+
+app = create_app()